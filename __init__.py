@@ -55,6 +55,16 @@ SYNCTYPE = (
 PALETTES = (
     ('QUAKE', "Quake palette", "Import/Export to Quake"),
     ('HEXEN2', "Hexen II palette", "Import/Export to Hexen II"),
+    ('CUSTOM', "Custom palette",
+     "Import/Export with a palette file (palette.lmp, .pal or PNG strip)"),
+)
+
+QUANTIZERS = (
+    ('TABLE', "Lookup table", "Map colours through a cached per-palette table"),
+    ('KDTREE', "K-d tree",
+     "Search a k-d tree of the palette colours, which can leave out the "
+     "fullbrights"),
+    ('LINEAR', "Linear scan", "Compare colours to every palette colour"),
 )
 
 
@@ -208,6 +218,12 @@ class ImportMDL6(bpy.types.Operator, ImportHelper):
         default="QUAKE"
     )
 
+    palette_file: StringProperty(
+        name="Palette file",
+        description="Palette of the custom palette option",
+        subtype='FILE_PATH',
+    )
+
     import_scale: FloatProperty(
         name="Scale factor",
         description="Import model scale factor (usually 0.5)",
@@ -236,6 +252,26 @@ class ExportMDL6(bpy.types.Operator, ExportHelper):
         default="QUAKE",
     )
 
+    palette_file: StringProperty(
+        name="Palette file",
+        description="Palette of the custom palette option",
+        subtype='FILE_PATH',
+    )
+
+    quantizer: EnumProperty(
+        items=QUANTIZERS,
+        name="Skin quantizer",
+        description="How skin colours are mapped to the palette",
+        default="TABLE",
+    )
+
+    fullbrights: BoolProperty(
+        name="Fullbright colours",
+        description="Let skin colours use the fullbright palette entries "
+                    "(turning this off needs the k-d tree quantizer)",
+        default=True,
+    )
+
     export_scale: FloatProperty(
         name="Scale factor",
         description="Import model scale factor (usually 5)",
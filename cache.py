@@ -0,0 +1,63 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+import os
+import tempfile
+
+import numpy as np
+
+# The user cache directory shared by the lookup tables (quantize), the
+# normal cube maps (qnorm) and the skin cache (skincache). Everything in
+# it can be built again, so failing to write it is never an error.
+
+
+def cache_dir():
+    '''
+    Directory the cached tables and skins are kept in
+    '''
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME',
+                              os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'qfmdl')
+
+
+def save_table(path, table):
+    '''
+    Store table at path, through a temporary file so concurrent exports
+    never see a partial table. Failures are ignored, the table is then
+    simply built again next time.
+    '''
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(path))
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as file:
+            np.save(file, table)
+        os.replace(temp, path)
+    except OSError:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
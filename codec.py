@@ -0,0 +1,148 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+from struct import Struct
+from struct import error as StructError
+
+import numpy as np
+
+# Precompiled layouts of the on-disk records, see FORMAT.md.
+# Variable length parts (pixels, intervals, vertex blocks) follow the
+# fixed part of their record and are handled as arrays.
+
+IDENT = Struct("<4si")          # ident and version, to pick the header
+# the header up to synctype, followed by flags and size for version 6 and
+# up, and by numstverts for the Hexen II mission pack version 50
+HEADER = {
+    3: Struct("<4si10f7i"),
+    6: Struct("<4si10f7iif"),
+    50: Struct("<4si10f7iifi"),
+}
+SKIN = Struct("<i")             # group flag, followed by the pixels
+SKINGROUP = Struct("<i")        # pics of a group, then times and pixels
+FRAMETYPE = Struct("<i")        # group flag of a top level frame
+# bboxmin, bboxmax and name, followed by the vertex block. Version 3
+# frames have no name
+SIMPLEFRAME = {
+    3: Struct("<4B4B"),
+    6: Struct("<4B4B16s"),
+    50: Struct("<4B4B16s"),
+}
+# number of frames, bboxmin and bboxmax, followed by the times and the
+# simple frames (the group flag is read through FRAMETYPE)
+GROUPFRAME = Struct("<i4B4B")
+VERT = Struct("<4B")
+
+# skin vertices, triangles (NTRI for the Hexen II mission pack, version 50)
+# and frame vertices as numpy dtypes, for decoding whole sections at once
+STVERT_DTYPE = np.dtype([
+    ('onseam', '<i4'),
+    ('s', '<i4'),
+    ('t', '<i4'),
+])
+TRI_DTYPE = np.dtype([
+    ('facesfront', '<i4'),
+    ('verts', '<i4', (3,)),
+])
+NTRI_DTYPE = np.dtype([
+    ('facesfront', '<i4'),
+    ('verts', '<u2', (3,)),
+    ('stverts', '<u2', (3,)),
+])
+VERT_DTYPE = np.dtype([
+    ('r', 'u1', (3,)),
+    ('ni', 'u1'),
+])
+
+
+def decode_name(name):
+    '''
+    Decode a fixed size, nul padded name field
+    '''
+    return name.split(b"\0", 1)[0].decode("latin-1")
+
+
+class BufferReader:
+    '''
+    Sequential reader over a bytes-like object (bytes, memoryview or mmap)
+    that decodes records straight out of the buffer.
+    '''
+
+    def __init__(self, buffer, offset=0):
+        self.buffer = buffer
+        self.offset = offset
+
+    def read_struct(self, struct):
+        try:
+            data = struct.unpack_from(self.buffer, self.offset)
+        except StructError:
+            raise ValueError("truncated data at offset %d" % self.offset)
+        self.offset += struct.size
+        return data
+
+    def read_array(self, dtype, count):
+        '''
+        Copy count consecutive records into a numpy array of the given dtype
+        '''
+        data = np.frombuffer(self.buffer, dtype, count, self.offset).copy()
+        self.offset += data.nbytes
+        return data
+
+    def read_bytestring(self, size):
+        data = bytes(self.buffer[self.offset:self.offset + size])
+        self.offset += size
+        return data
+
+
+class BufferWriter:
+    '''
+    Sequential writer into a preallocated, zero filled bytearray: the
+    counterpart of BufferReader.
+    '''
+
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.offset = 0
+
+    def write_struct(self, struct, *data):
+        struct.pack_into(self.buffer, self.offset, *data)
+        self.offset += struct.size
+
+    def write_array(self, data):
+        self.write_bytestring(data.tobytes())
+
+    def write_bytestring(self, data, size=-1):
+        if size == -1:
+            size = len(data)
+        data = data[:size]
+        # anything past the end of data is left zero filled
+        self.buffer[self.offset:self.offset + len(data)] = data
+        self.offset += size
+
+    def array(self, dtype, shape):
+        '''
+        Return a writable array of the given dtype and shape over the next
+        bytes of the buffer, so sections can be filled in place
+        '''
+        data = np.frombuffer(self.buffer, dtype, int(np.prod(shape)),
+                             self.offset).reshape(shape)
+        self.offset += data.nbytes
+        return data
@@ -16,13 +16,20 @@
 #
 # ##### END GPL LICENSE BLOCK #####
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import bpy
+import numpy as np
 from bpy_extras.object_utils import object_data_add
-from mathutils import Vector, Matrix
 
 from .utils import getPaletteFromName
+from .palettes import FULLBRIGHTS
 from .qfplist import pldata, PListError
-from .qnorm import map_normal
+from .qnorm import map_normals
+from .quantize import quantize_tiles
+from .skincache import image_tiles, load_skin, load_tiles, record_key
+from .skincache import save_skin, save_tiles, skin_key, tile_digests
 from .mdl import MDL
 from .constants import MDLEffects, MDLSyncType
 
@@ -49,41 +56,95 @@ def check_faces(mesh):
     return True
 
 
-def convert_image(image, palette):
-    size = image.size
-    skin = MDL.Skin()
-    skin.type = 0
-    skin.pixels = bytearray(size[0] * size[1])  # preallocate
-    cache = {}
-    pixels = image.pixels[:]
-    for y in range(size[1]):
-        for x in range(size[0]):
-            outind = y * size[0] + x
-            # quake textures are top to bottom, but blender images
-            # are bottom to top
-            inind = ((size[1] - 1 - y) * size[0] + x) * 4
-            rgb = pixels[inind: inind + 3]  # ignore alpha
-            rgb = tuple(map(lambda x: int(x * 255 + 0.5), rgb))
-            if rgb not in cache:
-                best = (3*256*256, -1)
-                for i, p in enumerate(palette):
-                    if i > 255:     # should never happen
-                        break
-                    r = 0
-                    for x in map(lambda a, b: (a - b) ** 2, rgb, p):
-                        r += x
-                    if r < best[0]:
-                        best = (r, i)
-                cache[rgb] = best[1]
-            skin.pixels[outind] = cache[rgb]
+def image_pixels(image):
+    '''
+    Pixels of image as a float32 array [height, width, 4], fetched with a
+    single foreach_get
+    '''
+    width, height = image.size
+    pixels = np.empty(width * height * 4, np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(height, width, 4)
+
+
+def quantize_image(pixels, palette, quantizer='TABLE', source=None,
+                   exclude=()):
+    '''
+    Skin bytes of the image pixels [height, width, 4] from image_pixels(),
+    never using the palette indices of exclude (see quantize.quantize).
+    Only uses numpy, so it can run outside the main thread. Skins
+    converted before are read back from the skin cache, and when the image
+    is named by source, only the tiles changed since its last conversion
+    are quantized again.
+    '''
+    height, width = pixels.shape[:2]
+    # quake textures are top to bottom, but blender images
+    # are bottom to top
+    pixels = pixels[::-1]
+    parts = image_tiles(width, height)
+    digests = tile_digests(pixels, parts)
+    record = previous = None
+    if source is not None:
+        record = record_key(source, width, height, palette, quantizer,
+                            exclude)
+        previous = load_tiles(record, len(parts), width * height)
+        if previous is not None and (previous[0] == digests).all():
+            return bytearray(previous[1])
+    key = skin_key(digests, width, height, palette, quantizer, exclude)
+    skin = load_skin(key, width * height)
+    if skin is None:
+        if previous is None:
+            indices = np.empty((height, width), np.uint8)
+            dirty = parts
+        else:
+            # patch the previous skin
+            indices = np.frombuffer(bytearray(previous[1]), np.uint8)
+            indices = indices.reshape(height, width)
+            changed = (previous[0] != digests).any(axis=1)
+            dirty = [tile for tile, flag in zip(parts, changed) if flag]
+        quantize_tiles(pixels, indices, dirty, palette, quantizer, exclude)
+        skin = bytearray(indices.tobytes())
+        save_skin(key, skin)
+    if record is not None:
+        save_tiles(record, digests, skin)
     return skin
 
 
+def image_source(image):
+    '''
+    Name of image for the tile records of the skin cache
+    '''
+    return "%s:%s" % (bpy.data.filepath, image.name)
+
+
+def convert_image(image, palette, quantizer='TABLE', exclude=()):
+    return MDL.Skin(pixels=quantize_image(image_pixels(image), palette,
+                                          quantizer, image_source(image),
+                                          exclude))
+
+
+def convert_images(jobs, palette, quantizer='TABLE', exclude=()):
+    '''
+    Set the pixels of the skins of jobs, a list of (skin, pixels, source)
+    with pixels from image_pixels() and source from image_source(),
+    quantizing the images concurrently. numpy releases the GIL for the
+    bulk of the work, so a thread pool is enough.
+    '''
+    def work(job):
+        return quantize_image(job[1], palette, quantizer, job[2], exclude)
+
+    workers = min(len(jobs), os.cpu_count() or 1)
+    if workers <= 1:
+        results = map(work, jobs)
+    else:
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(work, jobs))
+    for (skin, _, _), pixels in zip(jobs, results):
+        skin.pixels = pixels
+
+
 def null_skin(size):
-    skin = MDL.Skin()
-    skin.type = 0
-    skin.pixels = bytearray(size[0] * size[1])  # black skin
-    return skin
+    return MDL.Skin(pixels=bytearray(size[0] * size[1]))  # black skin
 
 
 def active_uv(mesh):
@@ -93,29 +154,35 @@ def active_uv(mesh):
     return None
 
 
-def make_skin(mdl, mesh, palette):
+def make_skin(mdl, mesh, palette, quantizer='TABLE', exclude=()):
     mdl.skinwidth, mdl.skinheight = (4, 4)
     skin = null_skin((mdl.skinwidth, mdl.skinheight))
 
     materials = bpy.context.object.data.materials
 
+    # bpy is not thread safe: the pixels are read here, and the skins are
+    # filled in by convert_images once every image has been collected
+    jobs = []
+
+    def convert(image):
+        skin = MDL.Skin()
+        jobs.append((skin, image_pixels(image), image_source(image)))
+        return skin
+
     if len(materials) > 0:
         for mat in materials:
             allTextureNodes = list(
                 filter(lambda node: node.type == "TEX_IMAGE",
                        mat.node_tree.nodes))
             if len(allTextureNodes) > 1:  # === skingroup
-                skingroup = MDL.Skin()
-                skingroup.type = 1
-                skingroup.skins = []
-                skingroup.times = []
+                skingroup = MDL.Skin(type=1)
                 sortedNodes = list(allTextureNodes)
                 sortedNodes.sort(key=lambda x: x.location[1], reverse=True)
                 for node in sortedNodes:
                     if node.type == "TEX_IMAGE":
                         image = node.image
                         mdl.skinwidth, mdl.skinheight = image.size
-                        skin = convert_image(image, palette)
+                        skin = convert(image)
                         skingroup.skins.append(skin)
                         # hardcoded at the moment
                         skingroup.times.append(0.1)
@@ -127,7 +194,7 @@ def make_skin(mdl, mesh, palette):
                         if (image.size[0] > 0 and image.size[1] > 0):
                             mdl.skinwidth, mdl.skinheight = (
                                 image.size[0], image.size[1])
-                            skin = convert_image(image, palette)
+                            skin = convert(image)
                         mdl.skins.append(skin)
             else:
                 # add empty skin - no texture nodes
@@ -135,6 +202,7 @@ def make_skin(mdl, mesh, palette):
     else:
         # add empty skin - no materials
         mdl.skins.append(skin)
+    convert_images(jobs, palette, quantizer, exclude)
 
 
 def build_tris(mesh):
@@ -147,50 +215,62 @@ def build_tris(mesh):
     # the layout. However, there seems to be nothing in the mdl format
     # preventing the use of duplicate 3d vertices to allow complete freedom
     # of the UV layout.
-    uvfaces = mesh.uv_layers.active.data
-    stverts = []
-    tris = []
-    vertmap = []    # map mdl vert num to blender vert num (for 3d verts)
-    vuvdict = {}
-    for face in mesh.polygons:
-        fv = list(face.vertices)
-        uv = uvfaces[face.loop_start:face.loop_start + face.loop_total]
-        uv = list(map(lambda a: a.uv, uv))
-        face_tris = []
-        for i in range(1, len(fv) - 1):
-            # blender's and quake's vertex order are opposed
-            face_tris.append([(fv[0], tuple(uv[0])),
-                              (fv[i + 1], tuple(uv[i + 1])),
-                              (fv[i], tuple(uv[i]))])
-        for ft in face_tris:
-            tv = []
-            for vuv in ft:
-                if vuv not in vuvdict:
-                    vuvdict[vuv] = len(stverts)
-                    vertmap.append(vuv[0])
-                    stverts.append(vuv[1])
-                tv.append(vuvdict[vuv])
-            tris.append(MDL.Tri(tv))
-    return tris, stverts, vertmap
+    polygons = mesh.polygons
+    starts = np.empty(len(polygons), np.int32)
+    totals = np.empty(len(polygons), np.int32)
+    polygons.foreach_get("loop_start", starts)
+    polygons.foreach_get("loop_total", totals)
+    loopverts = np.empty(len(mesh.loops), np.int32)
+    mesh.loops.foreach_get("vertex_index", loopverts)
+    uvs = np.empty(len(mesh.loops) * 2, np.float32)
+    mesh.uv_layers.active.data.foreach_get("uv", uvs)
+    uvs = uvs.reshape(-1, 2)
+
+    # fan triangulate the faces: triangle i of a face uses its loops 0,
+    # i + 1 and i (blender's and quake's vertex order are opposed)
+    counts = np.maximum(totals.astype(np.int64) - 2, 0)
+    first = np.repeat(starts.astype(np.int64), counts)
+    i = np.arange(len(first)) - np.repeat(np.cumsum(counts) - counts, counts)
+    corners = np.stack((first, first + i + 2, first + i + 1), axis=1)
+    corners = corners.reshape(-1)
+
+    # one mdl vert per distinct (vertex, uv) pair, numbered in order of
+    # first use. The uv bits are packed into one integer key, with -0.0
+    # made 0.0 as they compare equal
+    bits = (uvs[corners] + np.float32(0)).view(np.uint32).astype(np.uint64)
+    uvkeys, uvids = np.unique(bits[:, 0] << 32 | bits[:, 1],
+                              return_inverse=True)
+    keys = loopverts[corners].astype(np.int64) * len(uvkeys) + uvids.ravel()
+    _, firstuse, inverse = np.unique(keys, return_index=True,
+                                     return_inverse=True)
+    order = np.argsort(firstuse)
+    number = np.empty_like(order)
+    number[order] = np.arange(len(order))
+    used = corners[firstuse[order]]
+    vertmap = loopverts[used]    # map mdl vert num to blender vert num
+    stverts = uvs[used]
+
+    mdltris = np.zeros(len(corners) // 3, MDL.Tri)
+    mdltris['facesfront'] = 1
+    mdltris['verts'] = number[inverse.ravel()].reshape(-1, 3)
+    return mdltris, stverts, vertmap
 
 
 def convert_stverts(mdl, stverts):
-    for i, st in enumerate(stverts):
-        s, t = st
-        # quake textures are top to bottom, but blender images
-        # are bottom to top
-        s = round(s * (mdl.skinwidth - 1) + 0.5)
-        t = round((1 - t) * (mdl.skinheight - 1) + 0.5)
-        # ensure st is within the skin
-        s = ((s % mdl.skinwidth) + mdl.skinwidth) % mdl.skinwidth
-        t = ((t % mdl.skinheight) + mdl.skinheight) % mdl.skinheight
+    st = np.array(stverts, np.float64).reshape(-1, 2)
+    mdlstverts = np.zeros(len(st), MDL.STVert)
+    # quake textures are top to bottom, but blender images
+    # are bottom to top
+    s = np.round(st[:, 0] * (mdl.skinwidth - 1) + 0.5)
+    t = np.round((1 - st[:, 1]) * (mdl.skinheight - 1) + 0.5)
+    # ensure st is within the skin
+    mdlstverts['s'] = np.mod(s, mdl.skinwidth)
+    mdlstverts['t'] = np.mod(t, mdl.skinheight)
+    return mdlstverts
 
-        stverts[i] = MDL.STVert((s, t))
 
-
-def make_frame(mesh, vertmap, findex):
-    frame = MDL.Frame()
-    frame.name = "frame" + str(findex)
+def make_frame(mdl, mesh, vertmap, findex):
+    frame = MDL.Frame(name="frame" + str(findex))
 
     if bpy.context.object.data.shape_keys:
         shape_keys_amount = len(bpy.context.object.data.shape_keys.key_blocks)
@@ -198,22 +278,30 @@ def make_frame(mesh, vertmap, findex):
             frame.name = bpy.context.object.data.shape_keys.key_blocks[round(
                 findex)].name
 
-    for v in vertmap:
-        mv = mesh.vertices[v]
-        vert = MDL.Vert(tuple(mv.co), map_normal(mv.normal))
-        frame.add_vert(vert)
+    # read every vertex at once, then pick the mdl verts
+    vertmap = np.asarray(vertmap, np.int64)
+    coords = np.empty(len(mesh.vertices) * 3, np.float32)
+    mesh.vertices.foreach_get("co", coords)
+    verts = coords.reshape(-1, 3)[vertmap].astype(np.float64)
+    mesh.vertices.foreach_get("normal", coords)
+    normals = map_normals(coords.reshape(-1, 3)[vertmap], 'CUBE')
+    pose = mdl.add_pose(verts, normals)
+    frame.poses = range(pose, pose + 1)
+    frame.add_verts(verts)
     return frame
 
 
 def scale_verts(mdl):
-    tf = MDL.Frame()
-    for f in mdl.frames:
-        tf.add_frame(f, 0.0)    # let the frame class do the dirty work for us
-    size = Vector(tf.maxs) - Vector(tf.mins)
-    rsqr = tuple(map(lambda a, b: max(abs(a), abs(b)) ** 2, tf.mins, tf.maxs))
-    mdl.boundingradius = ((rsqr[0] + rsqr[1] + rsqr[2]) ** 0.5)
-    mdl.scale_origin = tf.mins
-    mdl.scale = tuple(map(lambda x: x / 255.0, size))
+    verts = mdl.verts
+    # like the frame bounds, the model bounds always include the origin
+    mins = np.minimum(verts.min(axis=(0, 1)), 0)
+    maxs = np.maximum(verts.max(axis=(0, 1)), 0)
+    size = maxs - mins
+    rsqr = np.maximum(np.abs(mins), np.abs(maxs)) ** 2
+    mdl.boundingradius = float(rsqr.sum() ** 0.5)
+    mdl.scale_origin = tuple(mins.tolist())
+    mdl.scale = tuple((size / 255.0).tolist())
+    mdl.verts = (verts - mins) / (size / 255.0)
     for f in mdl.frames:
         f.scale(mdl)
 
@@ -222,14 +310,12 @@ def calc_average_area(mdl):
     frame = mdl.frames[0]
     if frame.type:
         frame = frame.frames[0]
-    totalarea = 0.0
-    for tri in mdl.tris:
-        verts = tuple(map(lambda i: frame.verts[i], tri.verts))
-        a = Vector(verts[0].r) - Vector(verts[1].r)
-        b = Vector(verts[2].r) - Vector(verts[1].r)
-        c = a.cross(b)
-        totalarea += (c @ c) ** 0.5 / 2.0
-    return totalarea / len(mdl.tris)
+    verts = mdl.pose(frame.poses[0])[0][mdl.tris['verts']]
+    a = verts[:, 0] - verts[:, 1]
+    b = verts[:, 2] - verts[:, 1]
+    c = np.cross(a, b)
+    totalarea = (np.sqrt((c * c).sum(axis=1)) / 2.0).sum()
+    return float(totalarea / len(mdl.tris))
 
 
 def parse_effects(fx_group):
@@ -252,7 +338,8 @@ def get_properties(operator, mdl, obj, export_scale):
     return True
 
 
-def process_skin(mdl, skin, palette, ingroup=False):
+def process_skin(mdl, skin, palette, ingroup=False, quantizer='TABLE',
+                 exclude=()):
     if 'skins' in skin:
         if ingroup:
             raise ValueError("nested skin group")
@@ -262,12 +349,10 @@ def process_skin(mdl, skin, palette, ingroup=False):
         intervals = list(map(lambda x: float(x), intervals))
         while len(intervals) < len(skin['skins']):
             intervals.append(intervals[-1] + 0.1)
-        sk = MDL.Skin()
-        sk.type = 1
-        sk.times = intervals[1:len(skin['skins']) + 1]
-        sk.skins = []
+        sk = MDL.Skin(type=1, times=intervals[1:len(skin['skins']) + 1])
         for s in skin['skins']:
-            sk.skins.append(process_skin(mdl, s, palette, ingroup=True))
+            sk.skins.append(process_skin(mdl, s, palette, True,
+                                         quantizer, exclude))
         return sk
     else:
         # FIXME error handling
@@ -281,7 +366,7 @@ def process_skin(mdl, skin, palette, ingroup=False):
                                     int(image.size[0]), int(image.size[1])))
         else:
             mdl.skinwidth, mdl.skinheight = image.size
-        sk = convert_image(image, palette)
+        sk = convert_image(image, palette, quantizer, exclude)
         return sk
 
 
@@ -315,19 +400,31 @@ def process_frame(mdl, scene, frame, vertmap, ingroup=False,
     mesh = mdl.obj.to_mesh(preserve_all_data_layers=True)  # wysiwyg?
     if mdl.obj.qfmdl.xform:
         mesh.transform(mdl.obj.matrix_world)
-    fr = make_frame(mesh, vertmap, frameno)
+    fr = make_frame(mdl, mesh, vertmap, frameno)
     fr.name = name
     return fr
 
 
-def export_mdl(operator, context, filepath, palette, export_scale):
+def export_mdl(operator, context, filepath, palette, export_scale,
+               quantizer='TABLE', fullbrights=True, palette_file=""):
     obj = context.active_object
     obj.update_from_editmode()
     depsgraph = context.evaluated_depsgraph_get()
     ob_eval = obj.evaluated_get(depsgraph)
     objname = ob_eval.name_full
 
-    palette = getPaletteFromName(palette)
+    try:
+        palette = getPaletteFromName(palette,
+                                     bpy.path.abspath(palette_file))
+    except (OSError, ValueError) as err:
+        operator.report({'ERROR'}, "Can't load palette: %s" % err)
+        return {'CANCELLED'}
+    exclude = () if fullbrights else (FULLBRIGHTS,)
+    if exclude and quantizer != 'KDTREE':
+        operator.report({'ERROR'},
+                        "Leaving out the fullbrights needs the k-d tree "
+                        "quantizer")
+        return {'CANCELLED'}
 
     mdl = MDL(obj.name)
     mdl.obj = obj
@@ -337,7 +434,7 @@ def export_mdl(operator, context, filepath, palette, export_scale):
     mesh = bpy.context.active_object.to_mesh()
     mdl.tris, mdl.stverts, vertmap = build_tris(mesh)
     if not mdl.skins or (mdl.skinwidth):
-        make_skin(mdl, mesh, palette)
+        make_skin(mdl, mesh, palette, quantizer, exclude)
     if not mdl.frames:
         start_frame = context.scene.frame_start
         end_frame = context.scene.frame_end + 1
@@ -349,11 +446,11 @@ def export_mdl(operator, context, filepath, palette, export_scale):
             mesh = ob_eval.to_mesh()
             if mdl.obj.qfmdl.xform:
                 mesh.transform(mdl.obj.matrix_world)
-            eframe = make_frame(mesh, vertmap, fnum)
+            eframe = make_frame(mdl, mesh, vertmap, fnum)
             mdl.frames.append(eframe)
 
-    mdl.numverts = len(mdl.frames[0].verts)
-    convert_stverts(mdl, mdl.stverts)
+    mdl.numverts = len(vertmap)
+    mdl.stverts = convert_stverts(mdl, mdl.stverts)
     mdl.scale_factor = export_scale
     mdl.size = calc_average_area(mdl)
     scale_verts(mdl)
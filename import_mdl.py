@@ -17,13 +17,14 @@
 # ##### END GPL LICENSE BLOCK #####
 
 import bpy
-import importlib
+import numpy as np
 from bpy_extras.object_utils import object_data_add
-from mathutils import Vector, Matrix
 
 from .constants import MDLEffects, MDLSyncType
 from .mdl import MDL
 from .qfplist import pldata
+from .quantize import bands, palette_colors
+from .utils import getPaletteFromName
 
 
 def make_verts(mdl, framenum, subframenum=0):
@@ -36,18 +37,9 @@ def make_verts(mdl, framenum, subframenum=0):
     frame = mdl.frames[framenum]
     if frame.type:
         frame = frame.frames[subframenum]
-    verts = []
-    s = Vector([v for v in mdl.scale]) * mdl.scale_factor
-    o = Vector([v for v in mdl.scale_origin]) * mdl.scale_factor
-    m = Matrix((
-        (s.x, 0, 0, o.x),
-        (0, s.y, 0, o.y),
-        (0, 0, s.z, o.z),
-        (0, 0, 0, 1)
-    ))
-    for v in frame.verts:
-        verts.append(m @ Vector(v.r))
-    return verts
+    s = np.array(mdl.scale) * mdl.scale_factor
+    o = np.array(mdl.scale_origin) * mdl.scale_factor
+    return (mdl.pose(frame.poses[0])[0] * s + o).tolist()
 
 
 def make_faces(mdl):
@@ -56,49 +48,29 @@ def make_faces(mdl):
     the verts created.
     This also creates the uv coords for the faces
     '''
-    faces = []
-    uvs = []
-    for tri in mdl.tris:
-        # list of vertices in a tri
-        tv = list(tri.verts)
-        sts = []  # UV coords
-        if mdl.version < 50:
-            for v in tri.verts:
-                # UV vertex
-                stv = mdl.stverts[v]
-                s = stv.s
-                t = stv.t
-                if stv.onseam and not tri.facesfront:
-                    s += mdl.skinwidth / 2
-                # quake textures are top to bottom, but blender images
-                # are bottom to top
-                sts.append((
-                    s * 1.0 / mdl.skinwidth,
-                    1 - t * 1.0 / mdl.skinheight,
-                ))
-        else:
-            for v in tri.stverts:
-                # UV vertex from a mdl v50
-                stv = mdl.stverts[v]
-                s, t = (stv.s, stv.t)
-                if stv.onseam and not tri.facesfront:
-                    s += mdl.skinwidth / 2
-                sts.append((
-                    s * 1.0 / mdl.skinwidth,
-                    1 - t * 1.0 / mdl.skinheight,
-                ))
-
-        # blender's and quake's vertex order seem to be opposed
-        tv.reverse()
-        sts.reverse()
-        # annoyingly, blender can't have 0 in the final vertex, so rotate the
-        # face vertices and uvs
-        if not tv[2]:
-            tv = [tv[2]] + tv[:2]
-            sts = [sts[2]] + sts[:2]
-        faces.append(tv)
-        uvs.append(sts)
-    return faces, uvs
+    tris = mdl.tris
+    if mdl.version < 50:
+        stverts = mdl.stverts[tris['verts']]
+    else:
+        # UV vertices from a mdl v50
+        stverts = mdl.stverts[tris['stverts']]
+    s = stverts['s'].astype(np.float64)
+    t = stverts['t'].astype(np.float64)
+    backseam = (stverts['onseam'] != 0) & (tris['facesfront'] == 0)[:, None]
+    s[backseam] += mdl.skinwidth / 2
+    # quake textures are top to bottom, but blender images
+    # are bottom to top
+    sts = np.stack((s / mdl.skinwidth, 1 - t / mdl.skinheight), axis=-1)
+
+    # blender's and quake's vertex order seem to be opposed
+    tv = tris['verts'][:, ::-1].astype(np.int64)
+    sts = sts[:, ::-1]
+    # annoyingly, blender can't have 0 in the final vertex, so rotate the
+    # face vertices and uvs
+    rotate = tv[:, 2] == 0
+    tv[rotate] = np.roll(tv[rotate], 1, axis=1)
+    sts[rotate] = np.roll(sts[rotate], 1, axis=1)
+    return tv.tolist(), sts.tolist()
 
 
 def load_skins(mdl, palette):
@@ -107,25 +79,25 @@ def load_skins(mdl, palette):
     '''
     def load_skin(skin, name):
         skin.name = name
-        img = bpy.data.images.new(name, mdl.skinwidth, mdl.skinheight)
+        width, height = mdl.skinwidth, mdl.skinheight
+        img = bpy.data.images.new(name, width, height)
         mdl.images.append(img)
-        p = [0.0] * mdl.skinwidth * mdl.skinheight * 4
-        d = skin.pixels
-        for j in range(mdl.skinheight):
-            for k in range(mdl.skinwidth):
-                c = palette[d[j * mdl.skinwidth + k]]
-                # quake textures are top to bottom, but blender images
-                # are bottom to top
-                ln = ((mdl.skinheight - 1 - j) * mdl.skinwidth + k) * 4
-                p[ln + 0] = c[0] / 255.0  # Red
-                p[ln + 1] = c[1] / 255.0  # Green
-                p[ln + 2] = c[2] / 255.0  # Blue
-                p[ln + 3] = 1.0           # Alpha
-
-        img.pixels[:] = p[:]
+        # quake textures are top to bottom, but blender images
+        # are bottom to top
+        indices = np.frombuffer(skin.pixels, np.uint8, width * height)
+        indices = indices.reshape(height, width)[::-1]
+        for start, stop in bands(width, height):
+            np.take(colors, indices[start:stop], out=texels[start:stop])
+        img.pixels.foreach_set(pixels.ravel())
         img.pack()
         img.use_fake_user = True
 
+    # every skin has the same size, so they all go through one buffer.
+    # The RGBA of a palette index and of a pixel are handled as single
+    # 16 byte items, so the gather copies whole pixels
+    colors = palette_colors(palette).view('V16').ravel()
+    pixels = np.empty((mdl.skinheight, mdl.skinwidth, 4), np.float32)
+    texels = pixels.view('V16')[..., 0]
     mdl.images = []
     for i, skin in enumerate(mdl.skins):
         if skin.type:
@@ -189,14 +161,10 @@ def make_shape_key(mdl, framenum, subframenum=0):
     frame.key = mdl.obj.shape_key_add(name=name)
     frame.key.value = 0.0
     mdl.keys.append(frame.key)
-    s = Vector([v for v in mdl.scale]) * mdl.scale_factor
-    o = Vector([v for v in mdl.scale_origin]) * mdl.scale_factor
-    m = Matrix(((s.x,  0,  0, o.x),
-                (0, s.y,  0, o.y),
-                (0,  0, s.z, o.z),
-                (0,  0,  0,  1)))
-    for i, v in enumerate(frame.verts):
-        frame.key.data[i].co = m @ Vector(v.r)
+    s = np.array(mdl.scale) * mdl.scale_factor
+    o = np.array(mdl.scale_origin) * mdl.scale_factor
+    co = mdl.pose(frame.poses[0])[0] * s + o
+    frame.key.data.foreach_set("co", co.astype(np.float32).ravel())
 
 
 def build_shape_keys(mdl):
@@ -296,10 +264,10 @@ def merge_frames(mdl):
             if get_base(mdl.frames[j].name) != base:
                 break
             j += 1
-        f = MDL.Frame()
-        f.name = base
-        f.type = 1
-        f.frames = mdl.frames[i:j]
+        frames = mdl.frames[i:j]
+        f = MDL.Frame(type=1, name=base, frames=frames,
+                      poses=range(frames[0].poses.start,
+                                  frames[-1].poses.stop))
         mdl.frames[i:j] = [f]
         i += 1
 
@@ -399,11 +367,16 @@ def set_properties(mdl):
     mdl.obj.qfmdl.md16 = (mdl.ident == "MD16")
 
 
-def import_mdl(operator, context, filepath, palette, import_scale):
+def import_mdl(operator, context, filepath, palette, import_scale,
+               palette_file=""):
     bpy.context.preferences.edit.use_global_undo = False
 
-    palette_module_name = "..{0}pal".format(palette.lower())
-    palette = importlib.import_module(palette_module_name, __name__).palette
+    try:
+        palette = getPaletteFromName(palette,
+                                     bpy.path.abspath(palette_file))
+    except (OSError, ValueError) as err:
+        operator.report({'ERROR'}, "Can't load palette: %s" % err)
+        return {'CANCELLED'}
 
     for obj in bpy.context.scene.objects:
         obj.select_set(False)
@@ -19,15 +19,93 @@
 
 # <pep8 compliant>
 
-from struct import unpack, pack
+import mmap
+import os
+import stat
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import codec, qnorm
+from .codec import BufferReader, BufferWriter
 from .constants import MDLEffects, MDLSyncType
-from .utils import read_byte, read_bytestring, read_float, read_int, read_string, read_ushort, write_byte, write_bytestring, write_float, write_int, write_string
+
+
+def is_path(source):
+    '''
+    Whether source names a file, as opposed to holding the data itself
+    '''
+    return isinstance(source, (str, os.PathLike))
+
+
+class Source:
+    '''
+    Context manager giving the data of an MDL file, given as a path, a
+    binary stream (read from its current position) or a bytes-like object,
+    as a bytes-like object. Files, and streams over a regular file at its
+    start, are mapped rather than read (an empty file, which can not be
+    mapped, gives b""). The mapping is closed on exit unless it was taken
+    over with detach().
+    '''
+
+    def __init__(self, source):
+        self.source = source
+        self.mapping = None
+
+    def __enter__(self):
+        source = self.source
+        if is_path(source):
+            with open(source, "rb") as file:
+                return self.map(file)
+        if not hasattr(source, 'read'):
+            return source
+        try:
+            mappable = (source.tell() == 0
+                        and stat.S_ISREG(os.fstat(source.fileno()).st_mode))
+        except (OSError, ValueError):
+            # not backed by a file
+            mappable = False
+        if not mappable:
+            return source.read()
+        buffer = self.map(source)
+        # consumed, as by read()
+        source.seek(0, os.SEEK_END)
+        return buffer
+
+    def map(self, file):
+        if not os.fstat(file.fileno()).st_size:
+            return b""
+        self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mapping
+
+    def __exit__(self, *exc):
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+    def detach(self):
+        '''
+        The mapping, which is then left open on exit
+        '''
+        mapping, self.mapping = self.mapping, None
+        return mapping
 
 
 class MDL:
     class Skin:
-        def __init__(self):
-            self.name = ''
+        __slots__ = ('type', 'name', 'width', 'height', 'pixels', 'times',
+                     'skins')
+
+        def __init__(self, type=0, pixels=None, times=None, skins=None,
+                     name='', width=0, height=0):
+            self.type = type
+            self.name = name
+            self.width = width
+            self.height = height
+            self.pixels = pixels
+            self.times = [] if times is None else times
+            self.skins = [] if skins is None else skins
 
         def info(self):
             info = {}
@@ -41,103 +119,72 @@ class MDL:
                 info['name'] = self.name
             return info
 
-        def read(self, mdl, sub=0):
+        def read(self, mdl, data, sub=0):
             self.width, self.height = mdl.skinwidth, mdl.skinheight
             if sub:
                 self.type = 0
-                self.read_pixels(mdl)
+                self.read_pixels(data)
                 return self
-            self.type = read_int(mdl.file)
+            self.type, = data.read_struct(codec.SKIN)
             if self.type:
                 # skin group
-                num = read_int(mdl.file)
-                self.times = read_float(mdl.file, num)
+                num, = data.read_struct(codec.SKINGROUP)
+                self.times = data.read_array('<f4', num).tolist()
                 self.skins = []
                 for _ in range(num):
-                    self.skins.append(MDL.Skin().read(mdl, 1))
-                    num -= 1
+                    self.skins.append(MDL.Skin().read(mdl, data, 1))
                 return self
-            self.read_pixels(mdl)
+            self.read_pixels(data)
             return self
 
-        def write(self, mdl, sub=0):
+        def nbytes(self, sub=0):
+            '''
+            Size in bytes of the written skin
+            '''
+            if sub:
+                return len(self.pixels)
+            if not self.type:
+                return codec.SKIN.size + len(self.pixels)
+            return (codec.SKIN.size + codec.SKINGROUP.size
+                    + 4 * len(self.times)
+                    + sum(subskin.nbytes(1) for subskin in self.skins))
+
+        def write(self, mdl, data, sub=0):
             if not sub:
-                write_int(mdl.file, self.type)
+                data.write_struct(codec.SKIN, self.type)
                 if self.type:
-                    write_int(mdl.file, len(self.skins))
-                    write_float(mdl.file, self.times)
+                    data.write_struct(codec.SKINGROUP, len(self.skins))
+                    data.write_array(np.array(self.times, '<f4'))
                     for subskin in self.skins:
-                        subskin.write(mdl, 1)
+                        subskin.write(mdl, data, 1)
                     return
-            write_bytestring(mdl.file, self.pixels)
+            data.write_bytestring(self.pixels)
 
-        def read_pixels(self, mdl):
+        def read_pixels(self, data):
             size = self.width * self.height
-            self.pixels = read_bytestring(mdl.file, size)
-
-    class STVert:
-        def __init__(self, st=None, onseam=False):
-            if not st:
-                st = (0, 0)
-            self.onseam = onseam
-            self.s, self.t = st
-            pass
-
-        def read(self, mdl):
-            self.onseam = read_int(mdl.file)
-            self.s, self.t = read_int(mdl.file, 2)
-            return self
-
-        def write(self, mdl):
-            write_int(mdl.file, self.onseam)
-            write_int(mdl.file, (self.s, self.t))
-
-    class Tri:
-        def __init__(self, verts=None, facesfront=True):
-            if not verts:
-                verts = (0, 0, 0)
-            self.facesfront = facesfront
-            self.verts = verts
+            self.pixels = data.read_bytestring(size)
 
-        def read(self, mdl):
-            self.facesfront = read_int(mdl.file)
-            self.verts = read_int(mdl.file, 3)
-            return self
-
-        def write(self, mdl):
-            write_int(mdl.file, self.facesfront)
-            write_int(mdl.file, self.verts)
-
-    class NTri:
-        def __init__(self, verts=None, facesfront=True, stverts=None):
-            if not verts:
-                verts = (0, 0, 0)
-            if not stverts:
-                stverts = (0, 0, 0)
-
-            self.facesfront = facesfront
-            self.verts = verts
-            self.stverts = stverts
-
-        def read(self, mdl):
-            self.facesfront = read_int(mdl.file)
-            self.verts = read_ushort(mdl.file, 3)
-            self.stverts = read_ushort(mdl.file, 3)
-            return self
-
-        def write(self, mdl):
-            write_int(mdl.file, self.facesfront)
-            write_int(mdl.file, self.verts)
+    # stverts and tris are kept as record arrays in their on-disk layout
+    STVert = codec.STVERT_DTYPE
+    Tri = codec.TRI_DTYPE
+    # Hexen II mission pack triangles index the st verts separately
+    NTri = codec.NTRI_DTYPE
 
     class Frame:
-        def __init__(self):
-            self.type = 0
-            self.name = ""
-            self.mins = [0, 0, 0]
-            self.maxs = [0, 0, 0]
-            self.verts = []
-            self.frames = []
-            self.times = []
+        __slots__ = ('type', 'name', 'mins', 'maxs', 'poses', 'frames',
+                     'times', 'frameno', 'key')
+
+        def __init__(self, type=0, name="", mins=(0, 0, 0), maxs=(0, 0, 0),
+                     poses=range(0), frames=None, times=None):
+            self.type = type
+            self.name = name
+            self.mins = mins
+            self.maxs = maxs
+            self.poses = poses  # rows of MDL.verts/MDL.normals
+            self.frames = [] if frames is None else frames
+            self.times = [] if times is None else times
+            self.frameno = None  # set by the importer
+            self.key = None  # shape key, set by the importer
 
         def info(self):
             info = {}
@@ -147,25 +194,28 @@ class MDL:
                 info['frames'] = []
                 for f in self.frames:
                     info['frames'].append(f.info())
-            if hasattr(self, 'frameno'):
+            if self.frameno is not None:
                 info['frameno'] = str(self.frameno)
             if self.name:
                 info['name'] = self.name
             return info
 
-        def add_vert(self, vert):
-            self.verts.append(vert)
-            for i, v in enumerate(vert.r):
-                self.mins[i] = min(self.mins[i], v)
-                self.maxs[i] = max(self.maxs[i], v)
+        def add_verts(self, verts):
+            mins = np.minimum(self.mins, verts.min(axis=0))
+            maxs = np.maximum(self.maxs, verts.max(axis=0))
+            self.mins = tuple(mins.tolist())
+            self.maxs = tuple(maxs.tolist())
 
         def add_frame(self, frame, time):
+            if self.type:
+                self.poses = range(self.poses.start, frame.poses.stop)
+            else:
+                self.poses = frame.poses
             self.type = 1
             self.frames.append(frame)
             self.times.append(time)
-            for i in range(3):
-                self.mins[i] = min(self.mins[i], frame.mins[i])
-                self.maxs[i] = max(self.maxs[i], frame.maxs[i])
+            self.mins = tuple(map(min, self.mins, frame.mins))
+            self.maxs = tuple(map(max, self.maxs, frame.maxs))
 
         def scale(self, mdl):
             self.mins = tuple(map(lambda x, s, t: int((x - t) / s),
@@ -175,105 +225,190 @@ class MDL:
             if self.type:
                 for subframe in self.frames:
                     subframe.scale(mdl)
-            else:
-                for vert in self.verts:
-                    vert.scale(mdl)
 
-        def read(self, mdl, numverts, sub=0):
+        def read(self, mdl, data, poses, sub=0):
             if sub:
                 self.type = 0
             else:
-                self.type = read_int(mdl.file)
+                self.type, = data.read_struct(codec.FRAMETYPE)
             if self.type:
-                num = read_int(mdl.file)
-                self.read_bounds(mdl)
-                self.times = read_float(mdl.file, num)
+                num, *bounds = data.read_struct(codec.GROUPFRAME)
+                self.read_bounds(bounds)
+                self.times = data.read_array('<f4', num).tolist()
                 self.frames = []
+                first = len(poses)
                 for _ in range(num):
-                    self.frames.append(MDL.Frame().read(mdl, numverts, 1))
+                    self.frames.append(MDL.Frame().read(mdl, data, poses, 1))
+                self.poses = range(first, len(poses))
                 return self
-            self.read_bounds(mdl)
-            self.read_name(mdl)
-            self.read_verts(mdl, numverts)
+            self.read_record(
+                mdl.version, data.read_struct(codec.SIMPLEFRAME[mdl.version]))
+            # only note where the vertex block starts, MDL.decode_pose
+            # decodes it when needed
+            self.poses = range(len(poses), len(poses) + 1)
+            poses.append(data.offset)
+            data.offset += mdl.posesize
             return self
 
-        def write(self, mdl, sub=0):
+        def nbytes(self, mdl, sub=0):
+            '''
+            Size in bytes of the written frame
+            '''
+            size = 0 if sub else codec.FRAMETYPE.size
+            if self.type:
+                return (size + codec.GROUPFRAME.size + 4 * len(self.times)
+                        + sum(frame.nbytes(mdl, 1) for frame in self.frames))
+            return size + codec.SIMPLEFRAME[mdl.version].size + mdl.posesize
+
+        def write(self, mdl, data, sub=0):
             if not sub:
-                write_int(mdl.file, self.type)
+                data.write_struct(codec.FRAMETYPE, self.type)
                 if self.type:
-                    write_int(mdl.file, len(self.frames))
-                    self.write_bounds(mdl)
-                    write_float(mdl.file, self.times)
+                    data.write_struct(codec.GROUPFRAME, len(self.frames),
+                                      *self.write_bounds())
+                    data.write_array(np.array(self.times, '<f4'))
                     for frame in self.frames:
-                        frame.write(mdl, 1)
+                        frame.write(mdl, data, 1)
                     return
-            self.write_bounds(mdl)
-            self.write_name(mdl)
-            self.write_verts(mdl)
-
-        def read_name(self, mdl):
+            record = self.write_bounds()
             if mdl.version >= 6:
-                name = read_string(mdl.file, 16)
+                record += (self.name.encode(),)
+            data.write_struct(codec.SIMPLEFRAME[mdl.version], *record)
+            self.write_verts(mdl, data)
+
+        def read_record(self, version, record):
+            '''
+            Set the bounds and the name from an unpacked simple frame record
+            '''
+            self.read_bounds(record)
+            if version >= 6:
+                self.name = codec.decode_name(record[8])
             else:
-                name = ""
-            if "\0" in name:
-                name = name[:name.index("\0")]
-            self.name = name
-
-        def write_name(self, mdl):
-            if mdl.version >= 6:
-                write_string(mdl.file, self.name, 16)
+                self.name = ""
+            return self
 
-        def read_bounds(self, mdl):
-            self.mins = read_byte(mdl.file, 4)[:3]  # discard normal index
-            self.maxs = read_byte(mdl.file, 4)[:3]  # discard normal index
+        def read_bounds(self, bounds):
+            self.mins = tuple(bounds[0:3])  # discard normal index
+            self.maxs = tuple(bounds[4:7])  # discard normal index
 
-        def write_bounds(self, mdl):
-            write_byte(mdl.file, self.mins + (0,))
-            write_byte(mdl.file, self.maxs + (0,))
+        def write_bounds(self):
+            return tuple(self.mins) + (0,) + tuple(self.maxs) + (0,)
 
-        def read_verts(self, mdl, num):
-            self.verts = []
-            for i in range(num):
-                self.verts.append(MDL.Vert().read(mdl))
+        def write_verts(self, mdl, data):
+            verts, normals = mdl.pose(self.poses[0])
+            # fill the vertex block in place
             if mdl.ident == 'MD16':
-                for i in range(num):
-                    v = MDL.Vert().read(mdl)
-                    r = tuple(map(lambda a, b: a + b / 256.0,
-                                  self.verts[i].r, v.r))
-                    self.verts[i].r = r
-
-        def write_verts(self, mdl):
-            for vert in self.verts:
-                vert.write(mdl, True)
-            if mdl.ident == 'MD16':
-                for vert in self.verts:
-                    vert.write(mdl, False)
-
-    class Vert:
-        def __init__(self, r=None, ni=0):
-            if not r:
-                r = (0, 0, 0)
-            self.r = r
-            self.ni = ni
-            pass
-
-        def read(self, mdl):
-            self.r = read_byte(mdl.file, 3)
-            self.ni = read_byte(mdl.file)
-            return self
+                # 8.8 fixed point: the high bytes, then the low bytes
+                block = data.array(codec.VERT_DTYPE, (2, mdl.numverts))
+                fixed = (verts * 256.0).astype(np.int64)
+                block['r'][0] = (fixed >> 8) & 255
+                block['r'][1] = fixed & 255
+            else:
+                block = data.array(codec.VERT_DTYPE, mdl.numverts)
+                block['r'] = verts.astype(np.int64) & 255
+            block['ni'] = normals
+
+    class Header:
+        '''
+        The fixed size header of an MDL file, as returned by MDL.peek()
+        '''
+        __slots__ = ('ident', 'version', 'scale', 'scale_origin',
+                     'boundingradius', 'eyeposition', 'numskins',
+                     'skinwidth', 'skinheight', 'numverts', 'numtris',
+                     'numframes', 'synctype', 'flags', 'size',
+                     'num_st_verts', 'frame_names')
 
-        def write(self, mdl, high=True):
-            if mdl.ident == 'MD16' and not high:
-                r = tuple(map(lambda a: int(a * 256) & 255, self.r))
+        def __init__(self):
+            self.ident = ""
+            self.version = 0
+            self.flags = 0
+            self.size = 0
+            self.frame_names = None
+
+        def read(self, buffer, frame_names=False):
+            '''
+            Unpack the header at the start of buffer. Returns None if
+            buffer does not hold a supported MDL file, or with frame_names
+            if its frame records are cut short. ident and version are set
+            either way (as far as buffer holds them).
+            '''
+            if len(buffer) < codec.IDENT.size:
+                return None
+            ident, self.version = codec.IDENT.unpack_from(buffer)
+            self.ident = ident.decode("latin-1")
+            if (self.ident not in ["IDPO", "MD16", "RAPO"]
+                    or self.version not in [3, 6, 50]
+                    or len(buffer) < codec.HEADER[self.version].size):
+                return None
+            header = codec.HEADER[self.version].unpack_from(buffer)
+            self.scale = header[2:5]
+            self.scale_origin = header[5:8]
+            self.boundingradius = header[8]
+            self.eyeposition = header[9:12]
+            self.numskins, self.skinwidth, self.skinheight = header[12:15]
+            self.numverts, self.numtris, self.numframes = header[15:18]
+            self.synctype = header[18]
+            if self.version >= 6:
+                self.flags, self.size = header[19:21]
+            if self.version == 50:
+                self.num_st_verts = header[21]
             else:
-                r = tuple(map(lambda a: int(a) & 255, self.r))
-            write_byte(mdl.file, r)
-            write_byte(mdl.file, self.ni)
+                self.num_st_verts = self.numverts
+            if frame_names:
+                try:
+                    self.read_frame_names(buffer)
+                except ValueError:
+                    # the frame records are cut short
+                    return None
+            return self
 
-        def scale(self, mdl):
-            self.r = tuple(map(lambda x, s, t: (x - t) / s,
-                               self.r, mdl.scale, mdl.scale_origin))
+        def read_frame_names(self, buffer):
+            '''
+            Collect the names of the simple frames, see iter_frame_records
+            '''
+            self.frame_names = [frame.name for _, frame, _
+                                in self.iter_frame_records(buffer)]
+
+        def iter_frame_records(self, buffer):
+            '''
+            Walk the frame records, skipping over the skins, the uv map, the
+            tris and the vertex blocks. Yields (group, frame, offset) for
+            every simple frame, where group is the enclosing group frame
+            (without its subframes) or None, and offset is where the vertex
+            block of the frame starts.
+            '''
+            data = BufferReader(buffer, codec.HEADER[self.version].size)
+            skinsize = self.skinwidth * self.skinheight
+            for _ in range(self.numskins):
+                group, = data.read_struct(codec.SKIN)
+                if group:
+                    num, = data.read_struct(codec.SKINGROUP)
+                    data.offset += num * (4 + skinsize)
+                else:
+                    data.offset += skinsize
+            tri = MDL.NTri if self.version == 50 else MDL.Tri
+            data.offset += (self.num_st_verts * MDL.STVert.itemsize
+                            + self.numtris * tri.itemsize)
+            posesize = self.numverts * codec.VERT.size
+            if self.ident == 'MD16':
+                posesize *= 2
+            record = codec.SIMPLEFRAME[self.version]
+            for _ in range(self.numframes):
+                group = None
+                num = 1
+                if data.read_struct(codec.FRAMETYPE)[0]:
+                    num, *bounds = data.read_struct(codec.GROUPFRAME)
+                    group = MDL.Frame(type=1)
+                    group.read_bounds(bounds)
+                    group.times = data.read_array('<f4', num).tolist()
+                for _ in range(num):
+                    frame = MDL.Frame().read_record(self.version,
+                                                    data.read_struct(record))
+                    if data.offset + posesize > len(buffer):
+                        raise ValueError("truncated vertex block at offset %d"
+                                         % data.offset)
+                    yield group, frame, data.offset
+                    data.offset += posesize
 
     def __init__(self, name="mdl", md16=False):
         self.name = name
@@ -288,90 +423,387 @@ class MDL:
         self.size = 0
         self.skins = []
         self.numverts = 0
-        self.stverts = []
-        self.tris = []
+        self.stverts = np.zeros(0, MDL.STVert)
+        self.tris = np.zeros(0, MDL.Tri)
         self.frames = []
+        # vertex data of every simple frame (pose), frames refer to
+        # their rows through Frame.poses
+        self._verts = np.zeros((0, 0, 3), np.uint8)
+        self._normals = np.zeros((0, 0), np.uint8)
+        self._new_poses = []
+        # lazily read models keep the source buffer and the offset of
+        # every pose's vertex block, and decode poses when accessed
+        self._source = None
+        self._mapping = None
+        self._poseoffsets = []
+        self._posecache = OrderedDict()
+        # guards the pose cache and the packing of poses, so threads can
+        # share a lazily read model
+        self._lock = threading.RLock()
+        self.cache_size = 0
         self.scale_factor = 1.0
 
-    def read(self, filepath):
-        # Reading MDL file header
-        self.file = open(filepath, "rb")
-        self.name = filepath.split('/')[-1]
-        self.name = self.name.split('.')[0]
-        self.ident = read_string(self.file, 4)
-        self.version = read_int(self.file)
-        if self.ident not in ["IDPO", "MD16", "RAPO"] or self.version not in [3, 6, 50]:
-            return None
-        self.scale = read_float(self.file, 3)
-        self.scale_origin = read_float(self.file, 3)
-        self.boundingradius = read_float(self.file)
-        self.eyeposition = read_float(self.file, 3)
-        numskins = read_int(self.file)
-        self.skinwidth, self.skinheight = read_int(self.file, 2)
-        numverts, numtris, numframes = read_int(self.file, 3)
-        self.synctype = read_int(self.file)
-        if self.version >= 6:
-            self.flags = read_int(self.file)
-            self.size = read_float(self.file)
+    def __enter__(self):
+        return self
 
-        if self.version == 6:
-            self.num_st_verts = numverts
-        if self.version == 50:
-            self.num_st_verts = read_int(self.file)
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def posesize(self):
+        '''
+        Size in bytes of the vertex block of a single pose
+        '''
+        if self.ident == 'MD16':
+            return self.numverts * codec.VERT.size * 2
+        return self.numverts * codec.VERT.size
+
+    @property
+    def posetype(self):
+        '''
+        Type of the decoded vertex positions: MD16 coordinates are 8.8
+        fixed point and are decoded to floats
+        '''
+        if self.ident == 'MD16':
+            return np.float32
+        return np.uint8
+
+    @property
+    def numposes(self):
+        if self._verts is None:
+            return len(self._poseoffsets) + len(self._new_poses)
+        return len(self._verts) + len(self._new_poses)
+
+    @property
+    def verts(self):
+        '''
+        Vertex positions of all poses, indexed [pose, vert, axis]
+        '''
+        self.pack_poses()
+        return self._verts
+
+    @verts.setter
+    def verts(self, verts):
+        self.pack_poses()
+        self._verts = verts
+
+    @property
+    def normals(self):
+        '''
+        Normal indices of all poses, indexed [pose, vert]
+        '''
+        self.pack_poses()
+        return self._normals
+
+    @normals.setter
+    def normals(self, normals):
+        self.pack_poses()
+        self._normals = normals
+
+    def pose(self, index):
+        '''
+        Return the vertex positions and normal indices of a single pose.
+        Poses of lazily read models are decoded on demand, keeping the
+        cache_size most recently used ones around.
+        '''
+        with self._lock:
+            if self._verts is not None:
+                return self.verts[index], self.normals[index]
+            if index < 0:
+                index += self.numposes
+            if index >= len(self._poseoffsets):
+                return self.verts[index], self.normals[index]
+            pose = self._posecache.get(index)
+            if pose is not None:
+                self._posecache.move_to_end(index)
+                return pose
+            if self._source is None:
+                raise ValueError("%s: poses accessed after close()"
+                                 % self.name)
+            pose = (np.empty((self.numverts, 3), self.posetype),
+                    np.empty(self.numverts, np.uint8))
+            self.decode_pose(self._source, self._poseoffsets[index], *pose)
+            if self.cache_size:
+                self._posecache[index] = pose
+                if len(self._posecache) > self.cache_size:
+                    self._posecache.popitem(last=False)
+            return pose
+
+    def add_pose(self, verts, normals):
+        '''
+        Append the vertex positions and normal indices of a new simple frame
+        and return its pose index. New poses are packed into verts/normals
+        the next time those are accessed, so building a long animation pose
+        by pose copies every pose only once.
+        '''
+        self._new_poses.append((verts, normals))
+        return self.numposes - 1
+
+    def pack_poses(self):
+        with self._lock:
+            if self._verts is None:
+                self.decode_poses()
+            if not self._new_poses:
+                return
+            verts, normals = map(np.stack, zip(*self._new_poses))
+            self._new_poses = []
+            if len(self._verts):
+                verts = np.concatenate((self._verts, verts))
+                normals = np.concatenate((self._normals, normals))
+            self._verts, self._normals = verts, normals
+
+    def close(self):
+        '''
+        Release the file mapping of a lazily read model. Poses that were not
+        decoded yet can no longer be accessed afterwards.
+        '''
+        with self._lock:
+            self._source = None
+            if self._mapping is not None:
+                self._mapping.close()
+                self._mapping = None
+
+    def remap_skins(self, table):
+        '''
+        Translate the pixels of every skin, in groups too, through table:
+        256 bytes mapping old palette indices to new ones (see
+        quantize.remap_table)
+        '''
+        for skin in self.skins:
+            for pic in skin.skins if skin.type else (skin,):
+                pic.pixels = pic.pixels.translate(table)
+
+    def calc_normals(self, method='CUBE', weld=True):
+        '''
+        Set the normal indices of every pose from the triangles and the
+        vertex positions, without blender: area weighted vertex normals
+        mapped with method (see qnorm.map_normals). With weld, vertices
+        at the same position in every pose (the copies of a vertex split
+        along a UV seam) share their normal.
+        '''
+        verts = self.verts
+        scale = np.array(self.scale, np.float32)
+        origin = np.array(self.scale_origin, np.float32)
+        groups = qnorm.weld(verts) if weld else None
+        normals = qnorm.vertex_normals(self.tris['verts'],
+                                       verts * scale + origin, groups)
+        self.normals = qnorm.map_normals(normals.reshape(-1, 3),
+                                         method).reshape(normals.shape[:2])
+
+    @staticmethod
+    def peek(source, frame_names=False):
+        '''
+        Read only the header of an MDL file, given as a path, a binary
+        stream or a bytes-like object (see Source), without decoding the
+        rest of the model. With
+        frame_names, the names of the simple frames are collected too by
+        walking the frame records. Returns an MDL.Header, or None if source
+        is not a supported MDL file.
+        '''
+        with Source(source) as buffer:
+            return MDL.Header().read(buffer, frame_names)
+
+    def iter_frames(self, source, dequantize=False):
+        '''
+        Generate the simple frames of an MDL file, given as a path, a binary
+        stream or a bytes-like object (see Source), one at a time without
+        building MDL.frames or the verts and normals arrays. The header is read into the model, and
+        (group, frame, verts, normals) is yielded for every simple frame,
+        group being the enclosing group frame or None. verts are the raw
+        coordinates of the pose, or model coordinates (float32) scaled by
+        scale and scale_origin when dequantize is set.
+        '''
+        with Source(source) as buffer:
+            header = self.read_header(buffer)
+            if not header:
+                raise ValueError("Unrecognized format: %s %d"
+                                 % (self.ident, self.version))
+            scale = np.array(self.scale, np.float32)
+            origin = np.array(self.scale_origin, np.float32)
+            for group, frame, offset in header.iter_frame_records(buffer):
+                verts = np.empty((self.numverts, 3), self.posetype)
+                normals = np.empty(self.numverts, np.uint8)
+                self.decode_pose(buffer, offset, verts, normals)
+                if dequantize:
+                    verts = verts * scale + origin
+                yield group, frame, verts, normals
+
+    def read(self, source, lazy=False, cache_size=0):
+        '''
+        Read the model from source: a path, a bytes-like object or a binary
+        stream (read from its current position). All parsing state is local
+        to the call, and files opened here are closed again, except for the
+        mapping a lazily read model keeps until close().
+        '''
+        name = source if is_path(source) else getattr(source, 'name', None)
+        if isinstance(name, (str, os.PathLike)):
+            self.name = os.path.basename(name).split('.')[0]
+        # map the file once and decode everything straight out of the
+        # mapping instead of issuing a read per field
+        data = Source(source)
+        with data as buffer:
+            mdl = self.read_buffer(buffer, lazy, cache_size)
+            if mdl and lazy:
+                # poses are decoded from the mapping on demand, see close()
+                self._mapping = data.detach()
+        return mdl
+
+    def read_header(self, buffer):
+        '''
+        Read the MDL file header at the start of buffer into the model.
+        Returns the MDL.Header, or None if buffer does not hold a supported
+        MDL file.
+        '''
+        header = MDL.Header()
+        valid = header.read(buffer)
+        self.ident, self.version = header.ident, header.version
+        if not valid:
+            return None
+        self.scale = header.scale
+        self.scale_origin = header.scale_origin
+        self.boundingradius = header.boundingradius
+        self.eyeposition = header.eyeposition
+        self.skinwidth, self.skinheight = header.skinwidth, header.skinheight
+        self.numverts = header.numverts
+        self.synctype = header.synctype
+        self.flags, self.size = header.flags, header.size
+        self.num_st_verts = header.num_st_verts
+        return header
+
+    def read_buffer(self, buffer, lazy=False, cache_size=0):
+        '''
+        Read the model from a bytes-like object. When lazy is set, only the
+        offsets of the frames' vertex blocks are recorded and poses are
+        decoded when accessed through pose(), verts or normals, the buffer
+        must then stay valid until the model is closed. The mapping of an
+        earlier lazy read is closed first.
+        '''
+        self.close()
+        header = self.read_header(buffer)
+        if not header:
+            return None
+        data = BufferReader(buffer, codec.HEADER[self.version].size)
 
         # read in the skin data
         self.skins = []
-        for _ in range(numskins):
-            self.skins.append(MDL.Skin().read(self))
+        for _ in range(header.numskins):
+            self.skins.append(MDL.Skin().read(self, data))
 
         # read in the st verts (uv map)
-        self.stverts = []
-        for _ in range(self.num_st_verts):
-            self.stverts.append(MDL.STVert().read(self))
+        self.stverts = data.read_array(MDL.STVert, self.num_st_verts)
         # read in the tris
-        self.tris = []
         if (self.version < 50):
-            for _ in range(numtris):
-                self.tris.append(MDL.Tri().read(self))
+            self.tris = data.read_array(MDL.Tri, header.numtris)
         else:
-            for _ in range(numtris):
-                self.tris.append(MDL.NTri().read(self))
-        # read in the frames
+            self.tris = data.read_array(MDL.NTri, header.numtris)
+        # read in the frames, the frame records only note where the
+        # vertex block of each pose starts
         self.frames = []
-        for _ in range(numframes):
-            self.frames.append(MDL.Frame().read(self, numverts))
+        self._poseoffsets = []
+        for _ in range(header.numframes):
+            self.frames.append(
+                MDL.Frame().read(self, data, self._poseoffsets))
+        if data.offset > len(buffer):
+            # only the lazy path leaves vertex blocks unread until now
+            raise ValueError("%s: truncated MDL file" % self.name)
+        self._new_poses = []
+        self._posecache.clear()
+        self.cache_size = cache_size
+        self._source = buffer
+        self._verts = self._normals = None
+        if not lazy:
+            self.decode_poses()
         return self
 
-    def write(self, filepath):
-        self.file = open(filepath, "wb")
-        write_string(self.file, self.ident, 4)
-        write_int(self.file, self.version)
-        write_float(self.file, tuple(
-            v * self.scale_factor for v in self.scale))
-        write_float(self.file, list(
-            v * self.scale_factor for v in self.scale_origin))
-        write_float(self.file, self.boundingradius * self.scale_factor)
-        write_float(self.file, tuple(
-            v * self.scale_factor for v in self.eyeposition))
-        write_int(self.file, len(self.skins))
-        write_int(self.file, self.skinwidth)
-        write_int(self.file, self.skinheight)
-        write_int(self.file, self.numverts)
-        write_int(self.file, len(self.tris))
-        write_int(self.file, len(self.frames))
-        write_int(self.file, self.synctype)
+    def decode_pose(self, buffer, offset, verts, normals):
+        '''
+        Decode the vertex block at offset into verts [numverts, 3] and
+        normals [numverts], one frombuffer per block
+        '''
+        numverts = self.numverts
+        if self.ident == 'MD16':
+            # the low bytes follow the regular vertex block
+            block = np.frombuffer(buffer, codec.VERT_DTYPE, 2 * numverts,
+                                  offset).reshape(2, numverts)
+            np.multiply(block['r'][1], np.float32(1 / 256.0), out=verts)
+            np.add(verts, block['r'][0], out=verts)
+            normals[:] = block['ni'][0]
+            return
+        block = np.frombuffer(buffer, codec.VERT_DTYPE, numverts, offset)
+        verts[:] = block['r']
+        normals[:] = block['ni']
+
+    def decode_poses(self):
+        '''
+        Decode every pose of a lazily read model into the verts and normals
+        arrays, and drop the source buffer
+        '''
+        numposes = len(self._poseoffsets)
+        verts = np.empty((numposes, self.numverts, 3), self.posetype)
+        normals = np.empty((numposes, self.numverts), np.uint8)
+        for i, offset in enumerate(self._poseoffsets):
+            pose = self._posecache.get(i)
+            if pose is not None:
+                verts[i], normals[i] = pose
+                continue
+            if self._source is None:
+                raise ValueError("%s: poses accessed after close()"
+                                 % self.name)
+            self.decode_pose(self._source, offset, verts[i], normals[i])
+        self._verts, self._normals = verts, normals
+        self._posecache.clear()
+        self.close()
+
+    def to_bytes(self):
+        '''
+        Return the model in MDL format. The whole file is assembled in a
+        single preallocated buffer.
+        '''
+        header = codec.HEADER[self.version]
+        size = (header.size
+                + sum(skin.nbytes() for skin in self.skins)
+                + self.stverts.nbytes + self.tris.nbytes
+                + sum(frame.nbytes(self) for frame in self.frames))
+        data = BufferWriter(size)
+        fields = [
+            self.ident.encode(),
+            self.version,
+            *(v * self.scale_factor for v in self.scale),
+            *(v * self.scale_factor for v in self.scale_origin),
+            self.boundingradius * self.scale_factor,
+            *(v * self.scale_factor for v in self.eyeposition),
+            len(self.skins),
+            self.skinwidth,
+            self.skinheight,
+            self.numverts,
+            len(self.tris),
+            len(self.frames),
+            self.synctype,
+        ]
         if self.version >= 6:
-            write_int(self.file, self.flags)
-            write_float(self.file, self.size)
+            fields += [self.flags, self.size]
+        if self.version == 50:
+            fields.append(len(self.stverts))
+        data.write_struct(header, *fields)
         # write out the skin data
         for skin in self.skins:
-            skin.write(self)
-        # write out the st verts (uv map)
-        for stvert in self.stverts:
-            stvert.write(self)
-        # write out the tris
-        for tri in self.tris:
-            tri.write(self)
+            skin.write(self, data)
+        # write out the st verts (uv map) and the tris, both are already
+        # in their on-disk layout
+        data.write_array(self.stverts)
+        data.write_array(self.tris)
         # write out the frames
         for frame in self.frames:
-            frame.write(self)
+            frame.write(self, data)
+        return bytes(data.buffer)
+
+    def write(self, target):
+        '''
+        Write the model to target: a path or a binary stream
+        '''
+        data = self.to_bytes()
+        if not is_path(target):
+            target.write(data)
+            return
+        with open(target, "wb") as file:
+            file.write(data)
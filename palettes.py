@@ -0,0 +1,281 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+import hashlib
+import importlib
+import os
+import zlib
+import struct
+from struct import Struct
+
+import numpy as np
+
+# Registry of the palettes known to the importer and exporter, by upper
+# case name. The built in palettes are loaded from their modules on first
+# use, and palette files (see read_palette) are loaded once per
+# modification. Registered palettes are shared by every operation. Palette
+# files are registered as FILE:<name> by default, and never under the name
+# of a built in palette, so a custom quake.lmp can not stand in for the
+# QUAKE palette.
+
+BUILTIN = {
+    'QUAKE': 'quakepal',
+    'HEXEN2': 'hexen2pal',
+}
+
+FILE_PREFIX = "FILE:"
+# the fullbright entries of the Quake and Hexen II palettes, which glow in
+# the game whatever the lighting
+FULLBRIGHTS = range(224, 256)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_CHUNK = Struct(">I4s")
+PNG_HEADER = Struct(">2I5B")
+# channels of the 8 bit PNG colour types
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+RIFF_HEADER = Struct("<4sI4s4sI2H")
+
+registry = {}
+# palette files already loaded, by path: (mtime, palette)
+files = {}
+
+
+class Palette(tuple):
+    '''
+    A 256 colour palette, as the tuple of its (r, g, b) entries so it can
+    be used wherever the palette modules are. The compact bytes of the
+    palette and the arrays derived from it are computed once.
+    '''
+
+    def __new__(cls, data, name=''):
+        '''
+        data is the RGB bytes of up to 256 colours, missing colours are
+        black
+        '''
+        data = bytes(data[:768]).ljust(768, b"\0")
+        self = super().__new__(cls, zip(data[0::3], data[1::3], data[2::3]))
+        self.name = name
+        self.data = data
+        # integer RGB [256, 3], as quantize.palette_array
+        self.array = np.frombuffer(data, np.uint8).reshape(256, 3).astype(
+            np.int64)
+        self.digest = hashlib.sha1(self.array.tobytes()).hexdigest()
+        # RGBA float32 [256, 4] of the palette indices, as image pixels
+        self.colors = np.ones((256, 4), np.float32)
+        self.colors[:, :3] = self.array / 255.0
+        return self
+
+    @classmethod
+    def from_colors(cls, colors, name=''):
+        return cls(bytes(c for color in colors[:256] for c in color), name)
+
+
+def raw_colors(data):
+    '''
+    Colours of a raw palette (Quake's palette.lmp): packed RGB triplets
+    '''
+    if not data or len(data) % 3 or len(data) > 768:
+        raise ValueError("not a raw palette")
+    return data
+
+
+def jasc_colors(data):
+    '''
+    Colours of a JASC (Paint Shop Pro) palette
+    '''
+    lines = data.decode("latin-1").split()
+    if lines[:2] != ["JASC-PAL", "0100"]:
+        raise ValueError("not a JASC palette")
+    count = int(lines[2])
+    values = [int(v) for v in lines[3:3 + 3 * count]]
+    if len(values) != 3 * count or not all(0 <= v <= 255 for v in values):
+        raise ValueError("truncated JASC palette")
+    return bytes(values)
+
+
+def riff_colors(data):
+    '''
+    Colours of a Microsoft RIFF palette
+    '''
+    if len(data) < RIFF_HEADER.size:
+        raise ValueError("truncated RIFF palette")
+    riff, _, kind, chunk, _, _, count = RIFF_HEADER.unpack_from(data)
+    if (riff, kind, chunk) != (b"RIFF", b"PAL ", b"data"):
+        raise ValueError("not a RIFF palette")
+    entries = data[RIFF_HEADER.size:RIFF_HEADER.size + 4 * count]
+    if len(entries) != 4 * count:
+        raise ValueError("truncated RIFF palette")
+    # the fourth byte of every entry is flags
+    return bytes(b for i, b in enumerate(entries) if i % 4 != 3)
+
+
+def unfilter(raw, stride, bpp, rows):
+    '''
+    Undo the PNG scanline filters of the first rows of the decompressed
+    image data raw
+    '''
+    image = bytearray(stride * rows)
+    prior = bytearray(stride)
+    for y in range(rows):
+        start = y * (stride + 1)
+        kind = raw[start]
+        line = bytearray(raw[start + 1:start + 1 + stride])
+        if len(line) != stride:
+            raise ValueError("truncated PNG image")
+        if kind == 1:
+            for x in range(bpp, stride):
+                line[x] = (line[x] + line[x - bpp]) & 255
+        elif kind == 2:
+            for x in range(stride):
+                line[x] = (line[x] + prior[x]) & 255
+        elif kind == 3:
+            for x in range(stride):
+                left = line[x - bpp] if x >= bpp else 0
+                line[x] = (line[x] + ((left + prior[x]) >> 1)) & 255
+        elif kind == 4:
+            for x in range(stride):
+                a = line[x - bpp] if x >= bpp else 0
+                b = prior[x]
+                c = prior[x - bpp] if x >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    pred = a
+                elif pb <= pc:
+                    pred = b
+                else:
+                    pred = c
+                line[x] = (line[x] + pred) & 255
+        elif kind != 0:
+            raise ValueError("bad PNG filter %d" % kind)
+        image[y * stride:(y + 1) * stride] = line
+        prior = line
+    return image
+
+
+def png_colors(data):
+    '''
+    Colours of a PNG palette strip: the first 256 pixels of the image, row
+    by row (a 256x1 strip or a 16x16 grid, for instance). Only 8 bit, non
+    interlaced images are supported.
+    '''
+    pos = len(PNG_SIGNATURE)
+    header = None
+    plte = b""
+    idat = []
+    while pos + PNG_CHUNK.size <= len(data):
+        length, kind = PNG_CHUNK.unpack_from(data, pos)
+        chunk = data[pos + PNG_CHUNK.size:pos + PNG_CHUNK.size + length]
+        pos += PNG_CHUNK.size + length + 4   # skip the crc
+        if kind == b"IHDR":
+            header = PNG_HEADER.unpack_from(chunk)
+        elif kind == b"PLTE":
+            plte = chunk
+        elif kind == b"IDAT":
+            idat.append(chunk)
+        elif kind == b"IEND":
+            break
+    if header is None:
+        raise ValueError("PNG image without header")
+    width, height, depth, ctype, _, _, interlace = header
+    channels = PNG_CHANNELS.get(ctype)
+    if depth != 8 or channels is None or interlace:
+        raise ValueError("unsupported PNG palette: %d bit, type %d, %s"
+                         % (depth, ctype, "interlaced" if interlace
+                            else "not interlaced"))
+    rows = min(height, -(-256 // width))
+    # only the rows holding the palette are decompressed
+    raw = zlib.decompressobj().decompress(b"".join(idat),
+                                          rows * (width * channels + 1))
+    image = unfilter(raw, width * channels, channels, rows)
+    pixels = np.frombuffer(image, np.uint8).reshape(-1, channels)[:256]
+    if ctype == 3:
+        rgb = np.frombuffer(plte, np.uint8).reshape(-1, 3)
+        if pixels.max(initial=0) >= len(rgb):
+            raise ValueError("PNG pixel outside of its palette")
+        rgb = rgb[pixels[:, 0]]
+    elif ctype in (0, 4):
+        rgb = pixels[:, :1].repeat(3, axis=1)
+    else:
+        rgb = pixels[:, :3]
+    return rgb.tobytes()
+
+
+def read_palette(path):
+    '''
+    RGB bytes of the palette file at path: a raw palette (palette.lmp or
+    a raw .pal), a JASC or RIFF .pal, or a PNG strip. The format is told
+    by the content, not by the extension.
+    '''
+    with open(path, "rb") as file:
+        data = file.read()
+    try:
+        if data.startswith(PNG_SIGNATURE):
+            return png_colors(data)
+        if data.startswith(b"JASC-PAL"):
+            return jasc_colors(data)
+        if data.startswith(b"RIFF"):
+            return riff_colors(data)
+        return raw_colors(data)
+    except (IndexError, struct.error, zlib.error) as err:
+        raise ValueError("bad palette file %s: %s" % (path, err))
+
+
+def register_palette(palette):
+    registry[palette.name] = palette
+    return palette
+
+
+def get_palette(name):
+    '''
+    The registered palette name, loading the built in palettes on first use
+    '''
+    name = name.upper()
+    palette = registry.get(name)
+    if palette is None:
+        if name not in BUILTIN:
+            raise KeyError("unknown palette: %s" % name)
+        module = importlib.import_module("." + BUILTIN[name], __package__)
+        palette = Palette.from_colors(module.palette, name)
+        register_palette(palette)
+    return palette
+
+
+def load_palette(path, name=None):
+    '''
+    Load and register the palette file at path (see read_palette), under
+    name or else FILE: and the upper case file name. A file is only read
+    again once it has been modified.
+    '''
+    path = os.path.abspath(os.fspath(path))
+    if name is None:
+        name = FILE_PREFIX + os.path.splitext(os.path.basename(path))[0]
+    name = name.upper()
+    if name in BUILTIN:
+        raise ValueError("%s is the name of a built in palette" % name)
+    mtime = os.stat(path).st_mtime_ns
+    cached = files.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = files[path] = mtime, Palette(read_palette(path), name)
+    palette = cached[1]
+    if palette.name != name:
+        palette = Palette(palette.data, name)
+    return register_palette(palette)
@@ -19,7 +19,11 @@
 
 # <pep8 compliant>
 
-from mathutils import Vector
+import os
+
+import numpy as np
+
+from .cache import cache_dir, save_table
 
 # Covert normals to quake's normal palette. Implementation taken from ajmdl
 #
@@ -37,65 +41,309 @@ from mathutils import Vector
 # we only need to check about 1/3rd of the normals.
 # Actually, about 1/14th (taniwha)
 x_group = (
-    (Vector((1.0000, 0.0000, 0.0000)), (52, 52, 52, 52, 143, 143, 143, 143)),
-    (Vector((0.9554, 0.2952, 0.0000)), (51, 51, 55, 55, 141, 141, 145, 145)),
-    (Vector((0.9511, 0.1625, 0.2629)), (53, 63, 57, 70, 142, 148, 146, 151)),
-    (Vector((0.8642, 0.4429, 0.2389)), (46, 61, 56, 69, 19, 147, 123, 150)),
-    (Vector((0.8507, 0.5257, 0.0000)), (41, 41, 54, 54, 18, 18, 116, 116)),
-    (Vector((0.8507, 0.0000, 0.5257)), (60, 67, 60, 67, 144, 155, 144, 155)),
-    (Vector((0.8090, 0.3090, 0.5000)), (48, 62, 58, 68, 16, 149, 124, 152)),
-    (Vector((0.7166, 0.6817, 0.1476)), (42, 43, 111, 100, 20, 25, 118, 117)),
-    (Vector((0.6882, 0.5878, 0.4253)), (47, 76, 140, 101, 21, 156, 125, 161)),
-    (Vector((0.6817, 0.1476, 0.7166)), (49, 65, 59, 66, 15, 153, 126, 154)),
-    (Vector((0.5878, 0.4253, 0.6882)), (50, 75, 139, 102, 17, 157, 128, 160))
+    ((1.0000, 0.0000, 0.0000), (52, 52, 52, 52, 143, 143, 143, 143)),
+    ((0.9554, 0.2952, 0.0000), (51, 51, 55, 55, 141, 141, 145, 145)),
+    ((0.9511, 0.1625, 0.2629), (53, 63, 57, 70, 142, 148, 146, 151)),
+    ((0.8642, 0.4429, 0.2389), (46, 61, 56, 69, 19, 147, 123, 150)),
+    ((0.8507, 0.5257, 0.0000), (41, 41, 54, 54, 18, 18, 116, 116)),
+    ((0.8507, 0.0000, 0.5257), (60, 67, 60, 67, 144, 155, 144, 155)),
+    ((0.8090, 0.3090, 0.5000), (48, 62, 58, 68, 16, 149, 124, 152)),
+    ((0.7166, 0.6817, 0.1476), (42, 43, 111, 100, 20, 25, 118, 117)),
+    ((0.6882, 0.5878, 0.4253), (47, 76, 140, 101, 21, 156, 125, 161)),
+    ((0.6817, 0.1476, 0.7166), (49, 65, 59, 66, 15, 153, 126, 154)),
+    ((0.5878, 0.4253, 0.6882), (50, 75, 139, 102, 17, 157, 128, 160))
 )
 y_group = (
-    (Vector((0.0000, 1.0000, 0.0000)), (32, 32, 104, 104, 32, 32, 104, 104)),
-    (Vector((0.0000, 0.9554, 0.2952)), (33, 30, 107, 103, 33, 30, 107, 103)),
-    (Vector((0.2629, 0.9511, 0.1625)), (36, 39, 109, 105, 34, 31, 122, 115)),
-    (Vector((0.2389, 0.8642, 0.4429)), (35, 38, 108, 97, 23, 29, 121, 113)),
-    (Vector((0.5257, 0.8507, 0.0000)), (44, 44, 112, 112, 27, 27, 119, 119)),
-    (Vector((0.0000, 0.8507, 0.5257)), (6, 28, 106, 90, 6, 28, 106, 90)),
-    (Vector((0.5000, 0.8090, 0.3090)), (37, 40, 110, 98, 22, 26, 120, 114)),
-    (Vector((0.1476, 0.7166, 0.6817)), (8, 71, 136, 92, 7, 77, 130, 91)),
-    (Vector((0.4253, 0.6882, 0.5878)), (45, 73, 138, 99, 24, 158, 131, 159)),
-    (Vector((0.7166, 0.6817, 0.1476)), (42, 43, 111, 100, 20, 25, 118, 117)),
-    (Vector((0.6882, 0.5878, 0.4253)), (47, 76, 140, 101, 21, 156, 125, 161))
+    ((0.0000, 1.0000, 0.0000), (32, 32, 104, 104, 32, 32, 104, 104)),
+    ((0.0000, 0.9554, 0.2952), (33, 30, 107, 103, 33, 30, 107, 103)),
+    ((0.2629, 0.9511, 0.1625), (36, 39, 109, 105, 34, 31, 122, 115)),
+    ((0.2389, 0.8642, 0.4429), (35, 38, 108, 97, 23, 29, 121, 113)),
+    ((0.5257, 0.8507, 0.0000), (44, 44, 112, 112, 27, 27, 119, 119)),
+    ((0.0000, 0.8507, 0.5257), (6, 28, 106, 90, 6, 28, 106, 90)),
+    ((0.5000, 0.8090, 0.3090), (37, 40, 110, 98, 22, 26, 120, 114)),
+    ((0.1476, 0.7166, 0.6817), (8, 71, 136, 92, 7, 77, 130, 91)),
+    ((0.4253, 0.6882, 0.5878), (45, 73, 138, 99, 24, 158, 131, 159)),
+    ((0.7166, 0.6817, 0.1476), (42, 43, 111, 100, 20, 25, 118, 117)),
+    ((0.6882, 0.5878, 0.4253), (47, 76, 140, 101, 21, 156, 125, 161))
 )
 z_group = (
-    (Vector((0.0000, 0.0000, 1.0000)), (5, 84, 5, 84, 5, 84, 5, 84)),
-    (Vector((0.2952, 0.0000, 0.9554)), (12, 85, 12, 85, 2, 82, 2, 82)),
-    (Vector((0.1625, 0.2629, 0.9511)), (14, 86, 134, 96, 4, 83, 132, 89)),
-    (Vector((0.4429, 0.2389, 0.8642)), (13, 74, 133, 95, 1, 81, 127, 87)),
-    (Vector((0.5257, 0.0000, 0.8507)), (11, 64, 11, 64, 0, 80, 0, 80)),
-    (Vector((0.0000, 0.5257, 0.8507)), (9, 79, 137, 93, 9, 79, 137, 93)),
-    (Vector((0.3090, 0.5000, 0.8090)), (10, 72, 135, 94, 3, 78, 129, 88)),
-    (Vector((0.6817, 0.1476, 0.7166)), (49, 65, 59, 66, 15, 153, 126, 154)),
-    (Vector((0.5878, 0.4253, 0.6882)), (50, 75, 139, 102, 17, 157, 128, 160)),
-    (Vector((0.1476, 0.7166, 0.6817)), (8, 71, 136, 92, 7, 77, 130, 91)),
-    (Vector((0.4253, 0.6882, 0.5878)), (45, 73, 138, 99, 24, 158, 131, 159))
+    ((0.0000, 0.0000, 1.0000), (5, 84, 5, 84, 5, 84, 5, 84)),
+    ((0.2952, 0.0000, 0.9554), (12, 85, 12, 85, 2, 82, 2, 82)),
+    ((0.1625, 0.2629, 0.9511), (14, 86, 134, 96, 4, 83, 132, 89)),
+    ((0.4429, 0.2389, 0.8642), (13, 74, 133, 95, 1, 81, 127, 87)),
+    ((0.5257, 0.0000, 0.8507), (11, 64, 11, 64, 0, 80, 0, 80)),
+    ((0.0000, 0.5257, 0.8507), (9, 79, 137, 93, 9, 79, 137, 93)),
+    ((0.3090, 0.5000, 0.8090), (10, 72, 135, 94, 3, 78, 129, 88)),
+    ((0.6817, 0.1476, 0.7166), (49, 65, 59, 66, 15, 153, 126, 154)),
+    ((0.5878, 0.4253, 0.6882), (50, 75, 139, 102, 17, 157, 128, 160)),
+    ((0.1476, 0.7166, 0.6817), (8, 71, 136, 92, 7, 77, 130, 91)),
+    ((0.4253, 0.6882, 0.5878), (45, 73, 138, 99, 24, 158, 131, 159))
 )
 
 
-def map_normal(n):
-    fn = Vector((abs(n.x), abs(n.y), abs(n.z)))
+# the groups as arrays, for map_normals: first quadrant normals [3, 11, 3]
+# and their indices in every quadrant [3, 11, 8]
+groups = (x_group, y_group, z_group)
+group_normals = np.array([[v for v, _ in g] for g in groups], np.float64)
+group_indices = np.array([[i for _, i in g] for g in groups], np.uint8)
+
+
+def build_anorms():
+    '''
+    The 162 MDL normals [162, 3]: every group entry is mirrored into the
+    octant of each of its indices
+    '''
+    anorms = np.zeros((162, 3), np.float32)
+    for vector, indices in (entry for group in groups for entry in group):
+        for quadrant, index in enumerate(indices):
+            sign = [-1 if quadrant & bit else 1 for bit in (4, 2, 1)]
+            anorms[index] = np.multiply(vector, sign)
+    return anorms
+
+
+anorms = build_anorms()
+# ways of mapping normals to their index, see map_normals
+METHODS = ('GROUP', 'EXACT', 'CUBE')
+# normals per batch of map_normals, bounds its temporary arrays
+BATCH = 1 << 16
+# texels along the side of a cube map face, see build_cube
+CUBE_SIZE = 256
+# cube map texels not entirely closest to a single normal
+AMBIGUOUS = 255
+# least lead of the nearest normal over the others at the corners of a
+# cube map texel, far above the rounding errors of the float32 search
+MARGIN = 1e-4
+# cube maps already loaded, by size
+cubes = {}
+
+
+def build_cube(size=CUBE_SIZE):
+    '''
+    The cube map [6, size, size] of the nearest normals. Face 2 * axis + s
+    holds the directions whose largest component is along axis, negative
+    when s is 1. Texel (i, j) of a face covers the directions d/|d| where
+    d[axis] is +-1 and the next two components (in x, y, z order after
+    axis) are u and v in [-1 + 2 i / size, -1 + 2 (i + 1) / size] and
+    [-1 + 2 j / size, -1 + 2 (j + 1) / size].
+
+    The faces are gnomonic projections, so texel edges are great circle
+    arcs and a texel is within the convex region of the sphere closest to
+    a normal as soon as its four corners are. Such texels hold the index
+    of that normal, the others hold AMBIGUOUS.
+    '''
+    edges = np.linspace(-1.0, 1.0, size + 1)
+    normals = anorms.astype(np.float64).T
+    cube = np.empty((6, size, size), np.uint8)
+    rows = max(2, BATCH // (size + 1))
+    for face in range(6):
+        axis, negative = divmod(face, 2)
+        nearest = np.empty((size + 1, size + 1), np.int64)
+        for start in range(0, size + 1, rows):
+            u = edges[start:start + rows]
+            corners = np.empty((len(u), size + 1, 3))
+            corners[..., axis] = -1.0 if negative else 1.0
+            corners[..., (axis + 1) % 3] = u[:, None]
+            corners[..., (axis + 2) % 3] = edges
+            corners /= np.linalg.norm(corners, axis=-1, keepdims=True)
+            dots = corners @ normals
+            best = dots.argmax(axis=-1)
+            top = np.partition(dots, -2, axis=-1)
+            best[top[..., -1] - top[..., -2] <= MARGIN] = AMBIGUOUS
+            nearest[start:start + rows] = best
+        texel = nearest[:-1, :-1]
+        same = ((texel == nearest[1:, :-1]) & (texel == nearest[:-1, 1:])
+                & (texel == nearest[1:, 1:]))
+        cube[face] = np.where(same, texel, AMBIGUOUS)
+    return cube
+
+
+def cube_map(size=CUBE_SIZE):
+    '''
+    The cube map of build_cube, cached in memory and in the cache
+    directory of the palette lookup tables
+    '''
+    cube = cubes.get(size)
+    if cube is not None:
+        return cube
+    path = os.path.join(cache_dir(), "normals-%d.npy" % size)
+    try:
+        cube = np.load(path)
+        if cube.shape != (6, size, size) or cube.dtype != np.uint8:
+            cube = None
+    except (OSError, ValueError):
+        cube = None
+    if cube is None:
+        cube = build_cube(size)
+        save_table(path, cube)
+    cubes[size] = cube
+    return cube
+
+
+def cube_normal(n, size=CUBE_SIZE):
+    '''
+    The cube map entry of the normal n: its index, or AMBIGUOUS
+    '''
+    components = (n[0], n[1], n[2])
+    magnitudes = [abs(c) for c in components]
+    major = max(magnitudes)
+    if not 0 < major < float('inf'):
+        return AMBIGUOUS
+    axis = magnitudes.index(major)
+    u = components[(axis + 1) % 3] / major
+    v = components[(axis + 2) % 3] / major
+    if not (-1 <= u <= 1 and -1 <= v <= 1):
+        return AMBIGUOUS
+    face = axis * 2 + (components[axis] < 0)
+    i = min(int((u + 1) * size / 2), size - 1)
+    j = min(int((v + 1) * size / 2), size - 1)
+    return int(cube_map(size)[face, i, j])
+
+
+def map_normal(n, method='GROUP'):
+    '''
+    The index of the normal n, searched with method (see map_normals)
+    '''
+    if method == 'CUBE':
+        index = cube_normal(n)
+        if index != AMBIGUOUS:
+            return index
+    if method != 'GROUP':
+        return int(map_normals((n[0], n[1], n[2]), 'EXACT')[0])
+    fx, fy, fz = abs(n[0]), abs(n[1]), abs(n[2])
     group = x_group
-    if fn.y > fn.x and fn.y > fn.z:
+    if fy > fx and fy > fz:
         group = y_group
-    if fn.z > fn.x and fn.z > fn.y:
+    if fz > fx and fz > fy:
         group = z_group
     best = 0
     best_dot = -1
     for i in range(len(group)):
-        dot = group[i][0].dot(fn)
+        vector = group[i][0]
+        dot = vector[0] * fx + vector[1] * fy + vector[2] * fz
         if dot > best_dot:
             best = i
             best_dot = dot
     quadrant = 0
-    if n.x < 0:
+    if n[0] < 0:
         quadrant += 4
-    if n.y < 0:
+    if n[1] < 0:
         quadrant += 2
-    if n.z < 0:
+    if n[2] < 0:
         quadrant += 1
     return group[best][1][quadrant]
+
+
+def group_search(normals):
+    # the same float64 arithmetic as map_normal, so the indices match
+    fx, fy, fz = np.abs(normals.astype(np.float64)).T
+    group = np.where((fy > fx) & (fy > fz), 1, 0)
+    group[(fz > fx) & (fz > fy)] = 2
+    vectors = group_normals[group]
+    dots = (vectors[..., 0] * fx[:, None] + vectors[..., 1] * fy[:, None]
+            + vectors[..., 2] * fz[:, None])
+    best = dots.argmax(axis=1)
+    quadrant = ((normals[:, 0] < 0) * 4 + (normals[:, 1] < 0) * 2
+                + (normals[:, 2] < 0))
+    return group_indices[group, best, quadrant]
+
+
+def exact_search(normals):
+    return (normals.astype(np.float32) @ anorms.T).argmax(axis=1)
+
+
+def cube_search(normals, size=CUBE_SIZE):
+    normals = normals.astype(np.float32)
+    magnitudes = np.abs(normals)
+    axis = magnitudes.argmax(axis=1)
+    rows = np.arange(len(normals))
+    major = magnitudes[rows, axis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = normals[rows, (axis + 1) % 3] / major
+        v = normals[rows, (axis + 2) % 3] / major
+    valid = ((major > 0) & (major < np.inf)
+             & (np.abs(u) <= 1) & (np.abs(v) <= 1))
+    u[~valid] = v[~valid] = 0
+    face = axis * 2 + (normals[rows, axis] < 0)
+    i = np.minimum(((u + 1) * (size / 2)).astype(np.int64), size - 1)
+    j = np.minimum(((v + 1) * (size / 2)).astype(np.int64), size - 1)
+    index = cube_map(size)[face, i, j]
+    index[~valid] = AMBIGUOUS
+    # the few normals near the edge of two regions are searched
+    missed = index == AMBIGUOUS
+    if missed.any():
+        index[missed] = exact_search(normals[missed])
+    return index
+
+
+def map_normals(normals, method='GROUP'):
+    '''
+    Normal indices (uint8 [n]) of the normals [n, 3], all at once, searched
+    with method:
+    GROUP: the shortcut of map_normal, with the same indices.
+    EXACT: the nearest of all 162 normals (highest dot product, ties to
+        the lowest index).
+    CUBE: the EXACT indices, read from a cube map (see build_cube) for all
+        but the normals close to the edge of two normals' regions.
+    '''
+    if method not in METHODS:
+        raise ValueError("unknown normal method: %s" % method)
+    search = {
+        'GROUP': group_search,
+        'EXACT': exact_search,
+        'CUBE': cube_search,
+    }[method]
+    normals = np.asarray(normals).reshape(-1, 3)
+    index = np.empty(len(normals), np.uint8)
+    for start in range(0, len(normals), BATCH):
+        index[start:start + BATCH] = search(normals[start:start + BATCH])
+    return index
+
+
+def weld(verts):
+    '''
+    Group index (int [n]) of every vertex of the poses verts [poses, n, 3]:
+    vertices at the same position in every pose, such as the copies of a
+    vertex split along a UV seam, share their group
+    '''
+    verts = np.asarray(verts)
+    rows = verts.transpose(1, 0, 2).reshape(verts.shape[1], -1)
+    if not rows.size:
+        return np.arange(len(rows))
+    return np.unique(rows, axis=0, return_inverse=True)[1].reshape(-1)
+
+
+def vertex_normals(tris, verts, groups=None):
+    '''
+    Area weighted unit vertex normals (float32 [poses, n, 3]) of the vertex
+    positions verts [poses, n, 3] of the triangles tris [m, 3], wound
+    clockwise seen from the front as in MDL files. When groups is given
+    (see weld), the normals of the vertices of a group are summed together.
+    Vertices of no triangle get a zero normal.
+    '''
+    verts = np.asarray(verts)
+    tris = np.asarray(tris, np.int64).reshape(-1, 3)
+    poses, count = verts.shape[:2]
+    if groups is None:
+        groups = np.arange(count)
+    size = int(groups.max()) + 1 if count else 0
+    # the group of every triangle corner
+    corners = groups[tris].T.reshape(-1)
+    normals = np.zeros((poses, count, 3), np.float32)
+    step = max(1, BATCH // max(len(tris), 1))
+    for start in range(0, poses, step):
+        batch = verts[start:start + step].astype(np.float64)
+        v0, v1, v2 = (batch[:, tris[:, k]] for k in range(3))
+        # the cross product is twice the area along the face normal
+        faces = np.cross(v2 - v0, v1 - v0)
+        frames = len(batch)
+        # every face adds to the sums of its three corners' groups
+        index = (np.arange(frames)[:, None] * size + corners).reshape(-1)
+        sums = np.stack([np.bincount(index,
+                                     np.tile(faces[..., axis], 3).reshape(-1),
+                                     frames * size)
+                         for axis in range(3)], axis=-1)
+        sums = sums.reshape(frames, size, 3)[:, groups]
+        length = np.linalg.norm(sums, axis=-1, keepdims=True)
+        np.divide(sums, length, out=sums, where=length > 0)
+        normals[start:start + step] = sums
+    return normals
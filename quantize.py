@@ -0,0 +1,450 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from .cache import cache_dir, save_table
+from .palettes import Palette
+
+# Map colours to the nearest entry of a 256 colour palette, for whole
+# images at once. Colours are compared by squared RGB distance in 0..255
+# integer space, and ties go to the lowest palette index.
+#
+# Three exact search methods are available:
+# TABLE: every palette gets a full 24 bit lookup table (16MB), built once
+#     and kept in the user cache directory, so quantizing is a table
+#     gather per pixel. Colours outside 0..255 are searched directly.
+# KDTREE: a k-d tree over the palette entries (see KDTree), which also
+#     supports weighted distances and excluded entries (the exclude
+#     argument of quantize, e.g. to keep skins off the fullbrights).
+# LINEAR: every distinct colour is compared to every palette entry.
+METHODS = ('TABLE', 'KDTREE', 'LINEAR')
+
+# colours searched per batch, bounds the [batch, 256] distance array
+BATCH = 4096
+# side of the cells the lookup table is built in, and cells per batch
+GRID = 8
+CELLS = 256
+# most palette entries in a k-d tree leaf
+LEAFSIZE = 8
+# integer colours are clipped to +-LIMIT: every method then computes its
+# distances exactly (squares stay below 2^53 in float64) and the packed
+# keys of unique_colors fit in int64. A single channel that far out of
+# range already decides the nearest entry by itself.
+LIMIT = 1 << 19
+# most pixels of the row bands images are converted in, this bounds the
+# temporary arrays of a conversion whatever the image size
+BAND_PIXELS = 1 << 16
+
+# lookup tables and k-d trees already loaded, by palette digest
+tables = {}
+trees = {}
+# skins are quantized from a thread pool: only one thread loads or builds
+# the table or tree of a palette, the others wait for it
+lock = threading.Lock()
+
+
+def palette_array(palette):
+    '''
+    The (up to) 256 usable colours of palette as an int64 array [n, 3]
+    '''
+    if isinstance(palette, Palette):
+        return palette.array
+    return np.array(palette[:256], np.int64).reshape(-1, 3)
+
+
+def palette_colors(palette):
+    '''
+    The RGBA float32 colours [256, 4] of the palette indices, as blender
+    image pixels
+    '''
+    if isinstance(palette, Palette):
+        return palette.colors
+    colors = np.ones((256, 4), np.float32)
+    rgb = palette_array(palette)
+    colors[:len(rgb), :3] = rgb / 255.0
+    return colors
+
+
+def bands(width, height):
+    '''
+    Split the rows of a width x height image into bands of at most
+    BAND_PIXELS pixels (at least one row). Yields (start, stop) rows.
+    '''
+    rows = max(1, BAND_PIXELS // max(width, 1))
+    for start in range(0, height, rows):
+        yield start, min(start + rows, height)
+
+
+def tiles(width, height, size):
+    '''
+    Split a width x height image into size x size tiles, smaller along the
+    right and bottom edges. Yields (rows, columns) slices, row by row.
+    '''
+    for top in range(0, height, size):
+        rows = slice(top, min(top + size, height))
+        for left in range(0, width, size):
+            yield rows, slice(left, min(left + size, width))
+
+
+def quantize_tiles(pixels, indices, parts, palette, method='TABLE',
+                   exclude=()):
+    '''
+    Quantize the tiles parts (see tiles()) of the float pixels
+    [height, width, 4] into indices [height, width], searching about
+    BAND_PIXELS pixels worth of tiles at a time
+    '''
+    def flush(batch):
+        colors = np.concatenate([pixels[tile].reshape(-1, 4)
+                                 for tile in batch])
+        index = quantize(colors, palette, method, exclude)
+        start = 0
+        for tile in batch:
+            target = indices[tile]
+            target[...] = index[start:start + target.size].reshape(
+                target.shape)
+            start += target.size
+
+    batch, count = [], 0
+    for rows, columns in parts:
+        batch.append((rows, columns))
+        count += (rows.stop - rows.start) * (columns.stop - columns.start)
+        if count >= BAND_PIXELS:
+            flush(batch)
+            batch, count = [], 0
+    if batch:
+        flush(batch)
+
+
+def to_rgb8(pixels):
+    '''
+    Round float RGB(A) pixels [..., 3 or 4] in 0..1 to integer RGB. NaN
+    becomes 0, and channels are clipped to +-LIMIT.
+    '''
+    rgb = pixels[..., :3].astype(np.float64) * 255 + 0.5
+    rgb = np.nan_to_num(rgb, nan=0.0, posinf=LIMIT, neginf=-LIMIT)
+    return np.clip(rgb, -LIMIT, LIMIT).astype(np.int64)
+
+
+def nearest(colors, palette):
+    '''
+    Index of the nearest palette colour for every integer RGB colour of
+    colors [n, 3]
+    '''
+    # |c - p|^2 = |c|^2 - 2 c.p + |p|^2, and |c|^2 does not change the
+    # nearest entry. Every term is an integer well below 2^53, so the
+    # float64 matrix product is exact and ties still go to the lowest index
+    palette = palette_array(palette).astype(np.float64)
+    norms = (palette * palette).sum(axis=1)
+    colors = colors.astype(np.float64)
+    index = np.empty(len(colors), np.uint8)
+    for start in range(0, len(colors), BATCH):
+        dist = norms - 2 * (colors[start:start + BATCH] @ palette.T)
+        index[start:start + BATCH] = dist.argmin(axis=1)
+    return index
+
+
+def remap_table(source, target, exclude=()):
+    '''
+    Translation table (256 bytes, for bytes.translate) from the indices of
+    palette source to the nearest colours of palette target. The indices
+    of exclude (as in KDTree, e.g. [range(224, 256)] for the Quake
+    fullbrights) only map among themselves: no other colour lands on them,
+    and they stay within them.
+    '''
+    colors = palette_array(source)
+    special = np.zeros(len(colors), bool)
+    for indices in exclude:
+        special[np.asarray(indices, np.intp)] = True
+    table = np.empty(len(colors), np.uint8)
+    inside = np.flatnonzero(special)
+    outside = np.flatnonzero(~special)
+    table[outside] = KDTree(target, exclude=[inside]).query(colors[outside])
+    if len(inside):
+        table[inside] = KDTree(target, exclude=[outside]).query(
+            colors[inside])
+    return table.tobytes().ljust(256, b"\0")
+
+
+def unique_colors(rgb):
+    '''
+    The distinct colours of the integer RGB colours rgb [n, 3], and the
+    index of every colour of rgb into them
+    '''
+    low = int(rgb.min(initial=0))
+    span = int(rgb.max(initial=0)) - low + 1
+    if span ** 3 >= 1 << 63:
+        # the packed keys would overflow
+        colors, inverse = np.unique(rgb, axis=0, return_inverse=True)
+        return colors, inverse.reshape(-1)
+    shifted = rgb - low
+    keys = (shifted[:, 0] * span + shifted[:, 1]) * span + shifted[:, 2]
+    keys, inverse = np.unique(keys, return_inverse=True)
+    colors = np.stack((keys // (span * span), keys // span % span,
+                       keys % span), axis=1) + low
+    return colors, inverse.reshape(-1)
+
+
+class KDTree:
+    '''
+    k-d tree over the entries of a palette, for batched nearest colour
+    queries. The distance is the squared RGB distance, weighted per
+    channel by weights, and entries can be left out by index, e.g.
+    exclude=[range(224, 256)] for the Quake fullbrights. Ties go to the
+    lowest index, as with the other methods.
+    '''
+    class Node:
+        __slots__ = ('low', 'high', 'axis', 'split', 'children', 'ids',
+                     'points', 'leaf')
+
+    def __init__(self, palette, weights=(1, 1, 1), exclude=(),
+                 leafsize=LEAFSIZE):
+        self.palette = palette_array(palette).astype(np.float64)
+        self.weights = np.array(weights, np.float64)
+        keep = np.ones(len(self.palette), bool)
+        for indices in exclude:
+            keep[np.asarray(indices, np.intp)] = False
+        if not keep.any():
+            raise ValueError("every palette entry is excluded")
+        self.leaves = 0
+        self.root = self.build(np.flatnonzero(keep), leafsize)
+
+    def build(self, ids, leafsize):
+        node = KDTree.Node()
+        points = self.palette[ids]
+        node.low = points.min(axis=0)
+        node.high = points.max(axis=0)
+        if len(ids) <= leafsize:
+            # ids stay in increasing order, for the tie breaking
+            node.children = None
+            node.ids = ids
+            node.points = points
+            node.leaf = self.leaves
+            self.leaves += 1
+            return node
+        # split the widest (weighted) axis at the median
+        node.axis = int(np.argmax((node.high - node.low) * self.weights))
+        order = np.argsort(points[:, node.axis], kind='stable')
+        half = len(ids) // 2
+        node.split = points[order[half], node.axis]
+        node.children = (self.build(np.sort(ids[order[:half]]), leafsize),
+                         self.build(np.sort(ids[order[half:]]), leafsize))
+        return node
+
+    def query(self, colors):
+        '''
+        Index of the nearest palette entry (uint8) for every colour of
+        colors [n, 3]
+        '''
+        colors = np.asarray(colors, np.float64).reshape(-1, 3)
+        index = np.empty(len(colors), np.uint8)
+        for start in range(0, len(colors), BATCH * 16):
+            index[start:start + BATCH * 16] = self.query_batch(
+                colors[start:start + BATCH * 16])
+        return index
+
+    def query_batch(self, colors):
+        weights = self.weights
+        best = np.full(len(colors), np.inf)
+        index = np.zeros(len(colors), np.intp)
+        home = np.empty(len(colors), np.intp)
+
+        def search(node, sel):
+            diff = colors[sel, np.newaxis] - node.points
+            dist = (diff * diff * weights).sum(axis=2)
+            nearest = dist.argmin(axis=1)
+            dist = dist[np.arange(len(sel)), nearest]
+            ids = node.ids[nearest]
+            better = ((dist < best[sel])
+                      | ((dist == best[sel]) & (ids < index[sel])))
+            sel = sel[better]
+            best[sel] = dist[better]
+            index[sel] = ids[better]
+
+        def descend(node, sel):
+            # a first guess from the leaf each colour falls in
+            if node.children is None:
+                home[sel] = node.leaf
+                search(node, sel)
+                return
+            left = colors[sel, node.axis] < node.split
+            descend(node.children[0], sel[left])
+            descend(node.children[1], sel[~left])
+
+        def visit(node, sel):
+            # only colours that may have a nearer (or equally near, lower
+            # index) entry in the node go on
+            gap = np.maximum(np.maximum(node.low - colors[sel],
+                                        colors[sel] - node.high), 0)
+            sel = sel[(gap * gap * weights).sum(axis=1) <= best[sel]]
+            if not len(sel):
+                return
+            if node.children is None:
+                search(node, sel[home[sel] != node.leaf])
+                return
+            for child in node.children:
+                visit(child, sel)
+
+        sel = np.arange(len(colors))
+        descend(self.root, sel)
+        visit(self.root, sel)
+        return index
+
+
+def excluded(exclude):
+    '''
+    The sorted, distinct palette indices of exclude (as in KDTree)
+    '''
+    return tuple(sorted({int(i) for indices in exclude for i in indices}))
+
+
+def palette_tree(palette, exclude=()):
+    '''
+    The k-d tree of palette without the entries of exclude, with the plain
+    RGB distance
+    '''
+    key = palette_digest(palette), excluded(exclude)
+    with lock:
+        tree = trees.get(key)
+        if tree is None:
+            tree = trees[key] = KDTree(palette, exclude=[key[1]])
+    return tree
+
+
+def build_table(palette):
+    '''
+    Build the lookup table [256, 256, 256] of palette. The colour cube is
+    split into GRID^3 cells, each cell keeps the palette entries that can
+    be nearest to one of its colours (those not further from the cell than
+    some entry is at most), and only those are searched for the colours
+    of the cell.
+    '''
+    palette = palette_array(palette).astype(np.int32)
+    corner = np.arange(0, 256, GRID, dtype=np.int32)
+    cells = np.stack(np.meshgrid(corner, corner, corner, indexing='ij'),
+                     axis=-1).reshape(-1, 3)
+    candidates = np.empty((len(cells), len(palette)), bool)
+    for start in range(0, len(cells), CELLS):
+        low = cells[start:start + CELLS, np.newaxis]
+        high = low + GRID - 1
+        near = np.clip(palette, low, high) - palette
+        far = np.maximum(np.abs(palette - low), np.abs(palette - high))
+        dmin = (near * near).sum(axis=2)
+        dmax = (far * far).sum(axis=2)
+        candidates[start:start + CELLS] = (
+            dmin <= dmax.min(axis=1, keepdims=True))
+    step = np.arange(GRID, dtype=np.int32)
+    offsets = np.stack(np.meshgrid(step, step, step, indexing='ij'),
+                       axis=-1).reshape(-1, 3)
+    # as in nearest(), the float32 products are exact small integers
+    colors = palette.astype(np.float32)
+    norms = (colors * colors).sum(axis=1)
+    count = candidates.sum(axis=1)
+    table = np.empty((len(cells), GRID ** 3), np.uint8)
+    # cells with the same number of candidates are searched together,
+    # their candidates in increasing index order to keep the tie breaking
+    for k in np.unique(count):
+        sel = np.flatnonzero(count == k)
+        ids = np.nonzero(candidates[sel])[1].reshape(-1, k)
+        if k == 1:
+            table[sel] = ids
+            continue
+        for start in range(0, len(sel), CELLS):
+            part = sel[start:start + CELLS]
+            pid = ids[start:start + CELLS]
+            pixels = (cells[part, np.newaxis] + offsets).astype(np.float32)
+            dist = norms[pid][:, np.newaxis] - 2 * np.matmul(
+                pixels, colors[pid].transpose(0, 2, 1))
+            table[part] = np.take_along_axis(pid, dist.argmin(axis=2),
+                                             axis=1)
+    side = 256 // GRID
+    table = table.reshape((side,) * 3 + (GRID,) * 3)
+    return table.transpose(0, 3, 1, 4, 2, 5).reshape(256, 256, 256)
+
+
+def palette_digest(palette):
+    if isinstance(palette, Palette):
+        return palette.digest
+    return hashlib.sha1(palette_array(palette).tobytes()).hexdigest()
+
+
+def lookup_table(palette):
+    '''
+    The lookup table of palette, memory mapped from the cache directory.
+    The table is built and stored there on first use; if the cache can
+    not be written, the table is kept in memory only.
+    '''
+    digest = palette_digest(palette)
+    with lock:
+        table = tables.get(digest)
+        if table is None:
+            table = tables[digest] = load_table(digest, palette)
+    return table
+
+
+def load_table(digest, palette):
+    path = os.path.join(cache_dir(), "palette-%s.npy" % digest)
+    try:
+        table = np.load(path, mmap_mode='r')
+        if table.shape != (256, 256, 256) or table.dtype != np.uint8:
+            table = None
+    except (OSError, ValueError):
+        table = None
+    if table is None:
+        table = build_table(palette)
+        save_table(path, table)
+    return table
+
+
+def quantize(pixels, palette, method='TABLE', exclude=()):
+    '''
+    Palette indices (uint8, same shape minus the channels) of the float
+    RGB(A) pixels [..., 3 or 4], searched with method (see METHODS).
+    The palette indices of exclude (as in KDTree) are never used, which
+    only the KDTREE method supports.
+    '''
+    if method not in METHODS:
+        raise ValueError("unknown quantization method: %s" % method)
+    if method != 'KDTREE' and excluded(exclude):
+        raise ValueError("only the KDTREE method can exclude entries")
+    rgb = to_rgb8(pixels)
+    shape = rgb.shape[:-1]
+    rgb = rgb.reshape(-1, 3)
+    if method != 'TABLE':
+        # search every distinct colour once
+        colors, inverse = unique_colors(rgb)
+        if method == 'KDTREE':
+            index = palette_tree(palette, exclude).query(colors)
+        else:
+            index = nearest(colors, palette)
+        return index[inverse].reshape(shape)
+    inside = ((rgb >= 0) & (rgb <= 255)).all(axis=1)
+    keys = rgb[inside]
+    keys = keys[:, 0] << 16 | keys[:, 1] << 8 | keys[:, 2]
+    index = np.empty(len(rgb), np.uint8)
+    index[inside] = lookup_table(palette).reshape(-1)[keys]
+    if not inside.all():
+        index[~inside] = nearest(rgb[~inside], palette)
+    return index.reshape(shape)
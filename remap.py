@@ -0,0 +1,86 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+import os
+
+from .mdl import MDL
+from .palettes import FULLBRIGHTS, get_palette
+from .quantize import remap_table
+
+# Convert the skins of MDL files from one palette to another (Quake to
+# Hexen II, for instance) without going through images: every palette
+# index is mapped to the nearest colour of the other palette once, and
+# the skins are translated byte by byte. Palettes are given as registered
+# palette names (see palettes.get_palette) or as palettes.
+#
+# Fullbright colours glow in the game whatever the lighting, so by default
+# the fullbright indices (the last 32 of the Quake and Hexen II palettes)
+# only map among themselves: ordinary colours never start glowing, and
+# glowing ones keep glowing.
+
+EXTENSION = ".mdl"
+
+
+def palette_table(source, target, exclude=(FULLBRIGHTS,)):
+    if isinstance(source, str):
+        source = get_palette(source)
+    if isinstance(target, str):
+        target = get_palette(target)
+    return remap_table(source, target, exclude)
+
+
+def remap_mdl(path, output, source, target, table=None,
+              exclude=(FULLBRIGHTS,)):
+    '''
+    Write the MDL file at path to output (a path or a binary stream; may
+    be path itself) with its skins converted from palette source to
+    palette target. exclude lists the indices that only map among
+    themselves (see quantize.remap_table), () for none. table, from
+    palette_table(), saves building the table again for every file.
+    '''
+    if table is None:
+        table = palette_table(source, target, exclude)
+    mdl = MDL()
+    if not mdl.read(path):
+        raise ValueError("%s: unrecognized format: %s %d"
+                         % (path, mdl.ident, mdl.version))
+    mdl.remap_skins(table)
+    mdl.write(output)
+
+
+def remap_directory(directory, output, source, target,
+                    exclude=(FULLBRIGHTS,)):
+    '''
+    Convert the skins of every MDL file of directory from palette source to
+    palette target, writing the models under the same names into output
+    (created if needed; may be directory itself), with exclude as in
+    remap_mdl. Returns the paths of the written files.
+    '''
+    table = palette_table(source, target, exclude)
+    os.makedirs(output, exist_ok=True)
+    written = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.lower().endswith(EXTENSION) or not os.path.isfile(path):
+            continue
+        remap_mdl(path, os.path.join(output, name), source, target, table)
+        written.append(os.path.join(output, name))
+    return written
@@ -0,0 +1,189 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from .cache import cache_dir
+from .quantize import excluded, palette_array, tiles
+
+# Quantized skins of earlier exports, kept in the user cache directory
+# under the digest of everything the conversion depends on: the source
+# pixels, their size, the palette, the quantization method and the
+# palette entries it leaves out. Unchanged skins are then read back
+# instead of quantized again, across exports and sessions.
+#
+# The pixels are hashed in TILE x TILE tiles. Every image also keeps a
+# tile record, the tile digests and skin of its last export, so after a
+# touch up only the tiles whose digest changed need quantizing again.
+#
+# Files are touched when used, and the least recently used ones are
+# removed once the directory grows past MAX_SIZE.
+
+# bump when the conversion changes, so older entries are never used
+VERSION = 4
+MAX_SIZE = 128 << 20
+TILE = 32
+DIGEST_SIZE = 16
+
+
+def skin_dir():
+    return os.path.join(cache_dir(), 'skins')
+
+
+def image_tiles(width, height):
+    return list(tiles(width, height, TILE))
+
+
+def tile_digests(pixels, parts):
+    '''
+    Digests [len(parts), DIGEST_SIZE] of the tiles parts of the float
+    pixels [height, width, 4]
+    '''
+    digests = b''.join(hashlib.blake2b(np.ascontiguousarray(pixels[tile]),
+                                       digest_size=DIGEST_SIZE).digest()
+                       for tile in parts)
+    return np.frombuffer(digests, np.uint8).reshape(-1, DIGEST_SIZE)
+
+
+def conversion(width, height, palette, method, exclude):
+    key = hashlib.sha1(b"%d %s %d %d\0" % (VERSION, method.encode(),
+                                           width, height))
+    key.update(palette_array(palette).tobytes())
+    key.update(bytes(excluded(exclude)))
+    return key
+
+
+def skin_key(digests, width, height, palette, method, exclude=()):
+    '''
+    Digest of the conversion of the pixels with the tile digests to the
+    palette with method, leaving out the palette indices of exclude
+    '''
+    key = conversion(width, height, palette, method, exclude)
+    key.update(digests.tobytes())
+    return key.hexdigest()
+
+
+def record_key(source, width, height, palette, method, exclude=()):
+    '''
+    Digest of the tile record of the image source (any string naming the
+    image), converted to the palette with method and exclude
+    '''
+    key = conversion(width, height, palette, method, exclude)
+    key.update(source.encode('utf-8', 'surrogateescape'))
+    return key.hexdigest()
+
+
+def load(name, size):
+    '''
+    The bytes of the cache file name, or None if it does not hold exactly
+    size bytes
+    '''
+    path = os.path.join(skin_dir(), name)
+    try:
+        with open(path, 'rb') as file:
+            data = file.read(size + 1)
+        if len(data) != size:
+            return None
+        # mark it as recently used
+        os.utime(path)
+    except OSError:
+        return None
+    return data
+
+
+def save(name, data):
+    '''
+    Store data as the cache file name, then trim the cache. As with the
+    lookup tables, a cache that can not be written is silently skipped.
+    '''
+    directory = skin_dir()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp, os.path.join(directory, name))
+    except OSError:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        return
+    evict(directory)
+
+
+def load_skin(key, size):
+    '''
+    The cached skin bytes of key, or None
+    '''
+    data = load(key + '.skin', size)
+    return None if data is None else bytearray(data)
+
+
+def save_skin(key, data):
+    save(key + '.skin', data)
+
+
+def load_tiles(key, count, size):
+    '''
+    The tile digests [count, DIGEST_SIZE] and skin bytes (size bytes) of
+    the tile record key, or None
+    '''
+    data = load(key + '.tiles', count * DIGEST_SIZE + size)
+    if data is None:
+        return None
+    digests = np.frombuffer(data, np.uint8, count * DIGEST_SIZE)
+    return digests.reshape(count, DIGEST_SIZE), data[count * DIGEST_SIZE:]
+
+
+def save_tiles(key, digests, skin):
+    save(key + '.tiles', digests.tobytes() + bytes(skin))
+
+
+def evict(directory, max_size=MAX_SIZE):
+    '''
+    Remove the least recently used skins and tile records until they take
+    at most max_size bytes
+    '''
+    try:
+        entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                   for entry in os.scandir(directory)
+                   if entry.name.endswith(('.skin', '.tiles'))]
+    except OSError:
+        return
+    total = sum(size for _, size, _ in entries)
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            # another export may have removed it already
+            pass
+        total -= size